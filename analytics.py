@@ -0,0 +1,199 @@
+# analytics.py
+"""Offline aggregates and exports over stored user programs.
+
+Records are streamed from the program database page by page, so memory stays
+bounded by the number of distinct programs/exercises, not by the user count.
+Several shard databases can be passed at once.
+
+    python analytics.py summary --top 20
+    python analytics.py summary --type "4 day верх/низ" --day day2
+    python analytics.py export users.csv
+    python analytics.py export exercises.parquet --table exercises
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from storage import STORAGE_DB, UserProgramStore
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet export is optional
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "10000"))
+
+TABLE_COLUMNS = {
+    "users": ["user_id", "type", "days", "sets_reps", "exercises"],
+    "exercises": ["user_id", "type", "day", "subgroup", "exercise"],
+}
+
+
+def stream_records(paths: Iterable[str]) -> Iterator[Tuple[str, dict]]:
+    for path in paths:
+        store = UserProgramStore(path)
+        try:
+            for user_id, record in store.iter_records():
+                if isinstance(record, dict):
+                    yield user_id, record
+        finally:
+            store.close()
+
+
+def iter_exercises(record: dict) -> Iterator[Tuple[str, str, str]]:
+    """``(day, subgroup, exercise)`` for every exercise; list programs use day "all"."""
+    program = record.get("program")
+    if isinstance(program, dict):
+        days = program.items()
+    elif isinstance(program, list):
+        days = [("all", program)]
+    else:
+        return
+    for day, exercises in days:
+        if not isinstance(exercises, list):
+            continue
+        for exercise in exercises:
+            subgroup, sep, name = str(exercise).partition(": ")
+            if not sep:
+                subgroup, name = "", subgroup
+            yield day, subgroup, name
+
+
+class Summary:
+    """Counters over streamed records; keys are interned strings, so size tracks the catalog."""
+
+    def __init__(self):
+        self.users = 0
+        self.types: Counter = Counter()
+        self.sets_reps: Counter = Counter()
+        self.days: Counter = Counter()
+        # (type, day, subgroup, exercise) -> users who chose it
+        self.exercises: Counter = Counter()
+
+    def add(self, record: dict):
+        self.users += 1
+        program_type = record.get("type", "Unknown")
+        self.types[program_type] += 1
+        self.sets_reps[record.get("sets_reps", "")] += 1
+        self.days[record.get("days")] += 1
+        for day, subgroup, exercise in iter_exercises(record):
+            self.exercises[(program_type, day, subgroup, exercise)] += 1
+
+    def top_exercises(self, top: int, program_type: Optional[str] = None, day: Optional[str] = None) -> Dict[str, List]:
+        """Most chosen exercises per muscle subgroup, optionally for one program type/day."""
+        by_subgroup: Dict[str, Counter] = {}
+        for (t, d, subgroup, exercise), count in self.exercises.items():
+            if (program_type and t != program_type) or (day and d != day):
+                continue
+            by_subgroup.setdefault(subgroup, Counter())[exercise] += count
+        return {subgroup: counter.most_common(top) for subgroup, counter in sorted(by_subgroup.items())}
+
+    def report(self, top: int, program_type: Optional[str] = None, day: Optional[str] = None) -> dict:
+        return {
+            "users": self.users,
+            "types": dict(self.types.most_common()),
+            "days": {str(k): v for k, v in self.days.most_common()},
+            "sets_reps": dict(self.sets_reps.most_common()),
+            "exercises": self.top_exercises(top, program_type, day),
+        }
+
+
+def table_rows(records: Iterable[Tuple[str, dict]], table: str) -> Iterator[list]:
+    for user_id, record in records:
+        program_type = record.get("type")
+        if table == "users":
+            yield [user_id, program_type, record.get("days"), record.get("sets_reps"),
+                   sum(1 for _ in iter_exercises(record))]
+        else:
+            for day, subgroup, exercise in iter_exercises(record):
+                yield [user_id, program_type, day, subgroup, exercise]
+
+
+def export_csv(rows: Iterator[list], columns: List[str], path: str) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def export_parquet(rows: Iterator[list], columns: List[str], path: str, batch_size: int = EXPORT_BATCH_SIZE) -> int:
+    """Write row groups of ``batch_size`` rows, so only one batch is in memory."""
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    writer = None
+    count = 0
+    batch: List[list] = []
+
+    def flush():
+        nonlocal writer
+        # Column values are stringified so every row group has the same schema
+        table = pyarrow.table({
+            name: [None if row[i] is None else str(row[i]) for row in batch]
+            for i, name in enumerate(columns)
+        })
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+        batch.clear()
+
+    try:
+        for row in rows:
+            batch.append(row)
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+        if batch or writer is None:
+            flush()
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", action="append", help=f"program database, repeat for shards (default {STORAGE_DB})")
+    commands = parser.add_subparsers(dest="command", required=True)
+    summary = commands.add_parser("summary", help="print aggregates as JSON")
+    summary.add_argument("--top", type=int, default=10, help="exercises shown per subgroup")
+    summary.add_argument("--type", dest="program_type", help="only exercises of this program type")
+    summary.add_argument("--day", help="only exercises of this day (day1..day4, or all for FullBody)")
+    export = commands.add_parser("export", help="export rows to .csv or .parquet")
+    export.add_argument("path")
+    export.add_argument("--table", choices=sorted(TABLE_COLUMNS), default="users")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    records = stream_records(args.db or [STORAGE_DB])
+    if args.command == "summary":
+        result = Summary()
+        for _, record in records:
+            result.add(record)
+        json.dump(result.report(args.top, args.program_type, args.day), sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return
+    if args.path.endswith(".parquet") and pyarrow is None:
+        parser.error("Parquet export needs pyarrow (pip install pyarrow)")
+    columns = TABLE_COLUMNS[args.table]
+    rows = table_rows(records, args.table)
+    if args.path.endswith(".parquet"):
+        count = export_parquet(rows, columns, args.path)
+    else:
+        count = export_csv(rows, columns, args.path)
+    logger.info("Exported %d %s rows to %s", count, args.table, args.path)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,225 @@
+# benchmark.py
+"""Offline benchmark of the main handlers and of storage saves.
+
+Synthetic updates go through the real dispatcher with a fake Bot API
+session (see fake_telegram.py), so no network access is needed.
+Results are printed as JSON; pass ``--output`` to keep them and
+``--compare`` to diff against an earlier run.
+
+    python benchmark.py --updates 2000 --users 1000,10000,100000 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+# Isolate the benchmark database and lift send pacing so handler cost is measured
+_tmpdir = tempfile.mkdtemp(prefix="bot-bench-")
+os.environ["STORAGE_DB"] = os.path.join(_tmpdir, "bench.db")
+for _name in ("SEND_GLOBAL_RATE", "SEND_CHAT_RATE", "SEND_CHAT_BURST"):
+    os.environ[_name] = "1e9"
+# Repeated presses are the workload here, not something to debounce
+os.environ["SUB_CHECK_DEBOUNCE"] = "0"
+os.environ["CALLBACK_DEDUPE_WINDOW"] = "0"
+
+import main  # noqa: E402
+import loader  # noqa: E402
+import storage  # noqa: E402
+from fake_telegram import FakeTelegramSession, callback_update, message_update  # noqa: E402
+
+SAMPLE_PROGRAM = {
+    "days": 4,
+    "type": "4 day верх/низ",
+    "sets_reps": "1-2 подхода по 3-6 повторений (Выполнять в 0-2 повторений в запасе)",
+    "program": {
+        day: [f"Группа {i}: Упражнение {day} {i}" for i in range(9)]
+        for day in ("day1", "day2", "day3", "day4")
+    },
+}
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+
+    return {"p50_ms": pick(0.50), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": ordered[-1] * 1000}
+
+
+async def run_scenario(name, make_updates, total, concurrency, session):
+    updates = make_updates(total)
+    latencies = []
+    calls_before = sum(session.calls.values())
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def feed(raw):
+        async with semaphore:
+            started = time.perf_counter()
+            await main.dp.feed_raw_update(loader.bot, raw)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(raw) for raw in updates))
+    await main.outbound.drain()
+    elapsed = time.perf_counter() - started
+    api_calls = sum(session.calls.values()) - calls_before
+    return {
+        "scenario": name,
+        "updates": total,
+        "throughput_per_s": total / elapsed,
+        "api_calls_per_update": api_calls / total,
+        **percentiles(latencies),
+    }
+
+
+def bench_save(user_counts, repeats=200):
+    """Cost of saving one changed user as the number of stored users grows."""
+    results = []
+    for count in user_counts:
+        store = storage.UserProgramStore(os.path.join(_tmpdir, f"save-{count}.db"))
+        store["seed"] = SAMPLE_PROGRAM
+        store.save()  # persists the string catalog
+        row = store.encode(SAMPLE_PROGRAM)
+        batch = 10000
+        for start in range(0, count, batch):
+            rows = [(str(i), row) for i in range(start, min(count, start + batch))]
+            store.write((rows, [], [], []))
+        timings = []
+        for i in range(repeats):
+            user_id = str((i * 7919) % count)
+            record = store[user_id]
+            record["days"] = i
+            started = time.perf_counter()
+            store.save(user_id)
+            timings.append(time.perf_counter() - started)
+        results.append({"users": count, "save_mean_ms": statistics.mean(timings) * 1000, **percentiles(timings)})
+        store.close()
+    return results
+
+
+async def bench_handler_save(recent_counts, repeats=200, reads_per_save=10):
+    """Cost of a handler's ``save_user_program()`` with write-behind running.
+
+    ``count`` users are read first, as if they all used the bot within the
+    last minute; each iteration then reads a few more users, changes one
+    record and saves without a user id, as the handlers do. The time covers
+    the save and the flush that writes it.
+    """
+    store = storage.user_program
+    write_behind = storage.write_behind
+    await write_behind.start()
+    results = []
+    try:
+        for count in recent_counts:
+            ids = [f"recent-{count}-{i}" for i in range(count)]
+            for user_id in ids:
+                store[user_id] = dict(SAMPLE_PROGRAM)
+            await write_behind.flush()
+            for user_id in ids:
+                store[user_id]
+            timings = []
+            for i in range(repeats):
+                for j in range(reads_per_save):
+                    store[ids[(i * reads_per_save + j) % count]]
+                record = store[ids[(i * 7919) % count]]
+                record["days"] = i
+                started = time.perf_counter()
+                storage.save_user_program()
+                await write_behind.flush()
+                timings.append(time.perf_counter() - started)
+            results.append({"scenario": f"save_user_program/{count} recent", **percentiles(timings)})
+    finally:
+        await write_behind.stop()
+    return results
+
+
+async def run(args):
+    session = FakeTelegramSession(latency=args.api_latency)
+    loader.bot.session = session
+    main.setup_dispatcher()
+    users = range(1_000_000, 1_000_000 + args.user_pool)
+    for user_id in users:
+        storage.user_program[str(user_id)] = dict(SAMPLE_PROGRAM)
+    storage.save_user_program()
+
+    def cycle(make):
+        return lambda total: [make(users[i % len(users)]) for i in range(total)]
+
+    def donate_flow(total):
+        updates = []
+        for i in range(0, total, 3):
+            user_id = users[i % len(users)]
+            updates += [message_update(user_id, "/donate"), message_update(user_id, "50"),
+                        callback_update(user_id, "cancel_donate")]
+        return updates[:total]
+
+    scenarios = [
+        ("start", cycle(lambda uid: message_update(uid, "/start"))),
+        ("programma", cycle(lambda uid: message_update(uid, "/programma"))),
+        ("check_subscription", cycle(lambda uid: callback_update(uid, "check_subscription", caption="..."))),
+        # Sequential per user: the donate steps depend on FSM state
+        ("donate_flow", donate_flow),
+    ]
+    results = []
+    for name, make in scenarios:
+        concurrency = 1 if name == "donate_flow" else args.concurrency
+        results.append(await run_scenario(name, make, args.updates, concurrency, session))
+    return results
+
+
+def compare(current, baseline):
+    base = {(r.get("scenario") or r.get("users")): r for r in baseline["handlers"] + baseline["save"]}
+    base.update((r["scenario"], r) for r in baseline.get("handler_save", []))
+    for result in current["handlers"] + current["save"] + current["handler_save"]:
+        key = result.get("scenario") or result.get("users")
+        if key not in base:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            old, new = base[key][metric], result[metric]
+            change = (new - old) / old * 100 if old else 0.0
+            flag = "  REGRESSION" if change > 10 else ""
+            print(f"{key!s:>20} {metric}: {old:8.3f} -> {new:8.3f} ms ({change:+.1f}%){flag}", file=sys.stderr)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=2000, help="updates per handler scenario")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--user-pool", type=int, default=1000, help="distinct users sending updates")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API latency, seconds")
+    parser.add_argument("--users", default="1000,10000,100000,1000000", help="stored user counts for the save benchmark")
+    parser.add_argument("--recent", default="100,1000,6000",
+                        help="recently read user counts for the save_user_program benchmark")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.INFO)
+
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "params": vars(args),
+        "handlers": asyncio.run(run(args)),
+        "handler_save": asyncio.run(bench_handler_save([int(n) for n in args.recent.split(",")])),
+        "save": bench_save([int(n) for n in args.users.split(",")]),
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main_cli()
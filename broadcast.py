@@ -0,0 +1,307 @@
+# broadcast.py
+"""Announcements to every stored user.
+
+A broadcast snapshots the user ids from ``user_program`` into a delivery
+table, then sends through its own outbound scheduler with many sends in flight.
+That scheduler is limited to ``BROADCAST_RATE`` (split between shards), a
+share of Telegram's global limit that leaves the rest to the running bot;
+the two processes don't coordinate, so keep BROADCAST_RATE plus the bot's
+own traffic under SEND_GLOBAL_RATE. Delivery status is written in batches;
+an interrupted broadcast resumes with the users still pending.
+
+Users who blocked the bot or deleted their account are removed from the
+database. A running bot process keeps its cached copy of such a user until
+it is evicted or the bot restarts, and writes it back only if the user
+unblocks the bot and changes their program, in which case they are a user
+again.
+
+    python broadcast.py send --file announcement.html
+    python broadcast.py resume
+    python broadcast.py status 3
+
+In sharded mode run it once per shard database
+(STORAGE_DB=...shardN.db SHARD_COUNT=N SHARD_INDEX=n).
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from sender import SEND_GLOBAL_RATE, OutboundScheduler, outbound
+from sharding import SHARD_COUNT
+from storage import STORAGE_DB, user_program
+
+logger = logging.getLogger(__name__)
+
+# Sends in flight; needs to exceed send rate x API latency to keep the limit saturated
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "100"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "10"))
+# Messages per second for the whole broadcast, across all shards; the bot keeps the rest
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", str(SEND_GLOBAL_RATE * 2 / 3)))
+
+PENDING, SENT, BLOCKED, FAILED = "pending", "sent", "blocked", "failed"
+
+
+class BroadcastStore:
+    """Broadcasts and their per-user delivery status in the program database."""
+
+    def __init__(self, path: str = STORAGE_DB):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast (id INTEGER PRIMARY KEY, text TEXT NOT NULL, "
+            "created_at REAL NOT NULL, finished_at REAL, ready INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(broadcast)")]
+        if "ready" not in columns:
+            # Broadcasts created before the flag existed had their audience inserted in full
+            self._conn.execute("ALTER TABLE broadcast ADD COLUMN ready INTEGER NOT NULL DEFAULT 1")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_delivery (broadcast_id INTEGER NOT NULL, user_id TEXT NOT NULL, "
+            "status TEXT NOT NULL, error TEXT, updated_at REAL, PRIMARY KEY (broadcast_id, user_id))"
+        )
+
+    def _execute_batch(self, statements):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for sql, rows in statements:
+                    self._conn.executemany(sql, rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def create(self, text: str, user_ids: Iterable[str], batch_size: int = BROADCAST_BATCH_SIZE) -> int:
+        """Create a broadcast addressed to ``user_ids``, inserted in batches.
+
+        The broadcast is marked ready together with its last batch, so one cut
+        short while its audience was being inserted is never resumed.
+        """
+        with self._lock:
+            broadcast_id = self._conn.execute(
+                "INSERT INTO broadcast (text, created_at, ready) VALUES (?, ?, 0)", (text, time.time())
+            ).lastrowid
+        insert = "INSERT OR IGNORE INTO broadcast_delivery (broadcast_id, user_id, status) VALUES (?, ?, ?)"
+        batch = []
+        for user_id in user_ids:
+            batch.append((broadcast_id, str(user_id), PENDING))
+            if len(batch) >= batch_size:
+                self._execute_batch([(insert, batch)])
+                batch = []
+        self._execute_batch([(insert, batch), ("UPDATE broadcast SET ready = 1 WHERE id = ?", [(broadcast_id,)])])
+        return broadcast_id
+
+    def get(self, broadcast_id: int) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, text, created_at, finished_at, ready FROM broadcast WHERE id = ?", (broadcast_id,)
+            ).fetchone()
+
+    def latest_unfinished(self) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM broadcast WHERE finished_at IS NULL AND ready = 1 ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+        return row[0] if row else None
+
+    def pending(self, broadcast_id: int, batch_size: int = BROADCAST_BATCH_SIZE) -> Iterator[str]:
+        """Pending user ids, paged so the audience is never loaded at once."""
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT user_id FROM broadcast_delivery WHERE broadcast_id = ? AND status = ? AND user_id > ? "
+                    "ORDER BY user_id LIMIT ?",
+                    (broadcast_id, PENDING, last, batch_size),
+                ).fetchall()
+            if not rows:
+                return
+            for (user_id,) in rows:
+                yield user_id
+            last = rows[-1][0]
+
+    def record(self, broadcast_id: int, results: List[tuple]):
+        """Store ``(user_id, status, error)`` results of one batch."""
+        now = time.time()
+        self._execute_batch([(
+            "UPDATE broadcast_delivery SET status = ?, error = ?, updated_at = ? WHERE broadcast_id = ? AND user_id = ?",
+            [(status, error, now, broadcast_id, user_id) for user_id, status, error in results],
+        )])
+
+    def finish(self, broadcast_id: int):
+        with self._lock:
+            self._conn.execute("UPDATE broadcast SET finished_at = ? WHERE id = ?", (time.time(), broadcast_id))
+
+    def counts(self, broadcast_id: int) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM broadcast_delivery WHERE broadcast_id = ? GROUP BY status",
+                (broadcast_id,),
+            ).fetchall()
+        return {PENDING: 0, SENT: 0, BLOCKED: 0, FAILED: 0, **dict(rows)}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Broadcast:
+    """Sends one broadcast's pending deliveries and records the outcome."""
+
+    def __init__(self, bot, store: BroadcastStore, broadcast_id: int, scheduler: OutboundScheduler = outbound,
+                 concurrency: int = BROADCAST_CONCURRENCY, batch_size: int = BROADCAST_BATCH_SIZE):
+        self.bot = bot
+        self.store = store
+        self.broadcast_id = broadcast_id
+        self.scheduler = scheduler
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        _, self.text, _, _, ready = store.get(broadcast_id)
+        if not ready:
+            raise ValueError(f"Broadcast {broadcast_id} was not fully created; send it again")
+        self._results: List[tuple] = []
+        self.done = 0
+        self.total = 0
+        self.started = 0.0
+
+    async def _deliver(self, user_id: str, semaphore: asyncio.Semaphore):
+        try:
+            await self.scheduler.send_message(self.bot, int(user_id), self.text)
+            result = (user_id, SENT, None)
+        except TelegramForbiddenError as e:
+            result = (user_id, BLOCKED, e.message)
+        except TelegramBadRequest as e:
+            result = (user_id, FAILED, e.message)
+        except Exception as e:
+            logger.warning("Broadcast %s: sending to %s failed: %s", self.broadcast_id, user_id, e)
+            result = (user_id, FAILED, str(e))
+        finally:
+            semaphore.release()
+        self._results.append(result)
+        self.done += 1
+        if len(self._results) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        results, self._results = self._results, []
+        if not results:
+            return
+        self.store.record(self.broadcast_id, results)
+        blocked = [user_id for user_id, status, _ in results if status == BLOCKED]
+        for user_id in blocked:
+            if user_id in user_program:
+                del user_program[user_id]
+        if blocked:
+            user_program.save()
+            logger.info("Broadcast %s: pruned %d users who blocked the bot", self.broadcast_id, len(blocked))
+
+    def progress(self) -> Dict[str, float]:
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.done
+        return {
+            "done": self.done,
+            "total": self.total,
+            "rate_per_s": rate,
+            "eta_seconds": remaining / rate if rate else float("inf"),
+        }
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            p = self.progress()
+            logger.info("Broadcast %s: %d/%d sent, %.1f msg/s, ETA %.0fs",
+                        self.broadcast_id, p["done"], p["total"], p["rate_per_s"], p["eta_seconds"])
+
+    async def run(self) -> Dict[str, int]:
+        self.total = self.store.counts(self.broadcast_id)[PENDING]
+        self.started = time.monotonic()
+        logger.info("Broadcast %s: %d deliveries pending", self.broadcast_id, self.total)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        reporter = asyncio.create_task(self._report())
+        try:
+            for user_id in self.store.pending(self.broadcast_id):
+                await semaphore.acquire()
+                task = asyncio.create_task(self._deliver(user_id, semaphore))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(set(tasks))
+        finally:
+            reporter.cancel()
+            for task in tasks:
+                task.cancel()
+            # Sends cut short stay pending and are retried on resume
+            self._flush()
+        counts = self.store.counts(self.broadcast_id)
+        if not counts[PENDING]:
+            self.store.finish(self.broadcast_id)
+        logger.info("Broadcast %s finished in %.0fs: %s", self.broadcast_id, time.monotonic() - self.started, counts)
+        return counts
+
+
+async def run_broadcast(broadcast_id: int) -> Dict[str, int]:
+    from loader import bot, close_bot
+
+    store = BroadcastStore()
+    scheduler = OutboundScheduler(global_rate=BROADCAST_RATE / SHARD_COUNT)
+    try:
+        return await Broadcast(bot, store, broadcast_id, scheduler=scheduler).run()
+    finally:
+        await close_bot()
+        store.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    send = commands.add_parser("send", help="create a broadcast to every stored user and start it")
+    text = send.add_mutually_exclusive_group(required=True)
+    text.add_argument("--text", help="message text (HTML)")
+    text.add_argument("--file", help="read the message text (HTML) from a file")
+    resume = commands.add_parser("resume", help="continue an interrupted broadcast")
+    resume.add_argument("broadcast_id", type=int, nargs="?", help="default: the latest unfinished one")
+    status = commands.add_parser("status", help="print delivery counts")
+    status.add_argument("broadcast_id", type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = BroadcastStore()
+    if args.command == "status":
+        print(store.counts(args.broadcast_id))
+        return
+    if args.command == "send":
+        if args.file:
+            with open(args.file, encoding="utf-8") as f:
+                message = f.read()
+        else:
+            message = args.text
+        broadcast_id = store.create(message, iter(user_program))
+        logger.info("Created broadcast %s", broadcast_id)
+    else:
+        broadcast_id = args.broadcast_id or store.latest_unfinished()
+        row = store.get(broadcast_id) if broadcast_id is not None else None
+        if row is None:
+            parser.error("no broadcast to resume")
+        if not row[4]:
+            parser.error(f"broadcast {broadcast_id} was interrupted while being created; send it again")
+    store.close()
+    try:
+        asyncio.run(run_broadcast(broadcast_id))
+    except KeyboardInterrupt:
+        logger.info("Broadcast %s interrupted; run `python broadcast.py resume %s` to continue", broadcast_id, broadcast_id)
+
+
+if __name__ == "__main__":
+    main_cli()
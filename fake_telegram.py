@@ -0,0 +1,130 @@
+# fake_telegram.py
+"""Offline stand-ins for the Telegram side: a Bot API session that answers
+locally and builders for synthetic updates, so the bot can be load-tested
+without network access."""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+
+_message_ids = itertools.count(1)
+
+
+class FakeTelegramSession(BaseSession):
+    """Bot API session that builds plausible responses instead of calling Telegram."""
+
+    def __init__(self, latency: float = 0.0, member_status: str = "member", **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.member_status = member_status
+        self.calls: Counter = Counter()
+
+    def _result(self, method: TelegramMethod) -> Any:
+        name = type(method).__name__
+        chat_id = getattr(method, "chat_id", None) or 1
+        if name == "GetMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bot", "username": "fake_bot"}
+        if name == "GetChatMember":
+            return {
+                "status": self.member_status,
+                "user": {"id": int(method.user_id), "is_bot": False, "first_name": "User"},
+            }
+        if method.__returning__ is bool:
+            return True
+        message_id = next(_message_ids)
+        message: Dict[str, Any] = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+        }
+        if getattr(method, "text", None):
+            message["text"] = method.text
+        if getattr(method, "caption", None):
+            message["caption"] = method.caption
+        if name == "SendPhoto":
+            message["photo"] = [{"file_id": f"fake-photo-{message_id}", "file_unique_id": f"u{message_id}", "width": 1, "height": 1}]
+        return message
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = json.dumps({"ok": True, "result": self._result(method)})
+        return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+    async def stream_content(self, url: str, headers=None, timeout: int = 30, chunk_size: int = 65536, raise_for_status: bool = True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def message_update(user_id: int, text: str) -> Dict[str, Any]:
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": _user(user_id),
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] if text.startswith("/") else None,
+        },
+    }
+
+
+def callback_update(user_id: int, data: str, text: Optional[str] = None, caption: Optional[str] = None) -> Dict[str, Any]:
+    message: Dict[str, Any] = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": 1, "is_bot": True, "first_name": "Bot"},
+    }
+    if caption is not None:
+        message["caption"] = caption
+        message["photo"] = [{"file_id": "fake-photo", "file_unique_id": "u", "width": 1, "height": 1}]
+    else:
+        message["text"] = text or "..."
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        },
+    }
+
+
+async def post_updates(url: str, updates: List[Dict[str, Any]], secret: Optional[str] = None, concurrency: int = 50) -> List[float]:
+    """Deliver updates to a webhook like Telegram does; returns per-request latencies."""
+    import aiohttp
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async with aiohttp.ClientSession() as session:
+        async def post(update):
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(url, json=update, headers=headers) as resp:
+                    resp.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(post(update) for update in updates))
+    return latencies
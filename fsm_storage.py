@@ -0,0 +1,184 @@
+# fsm_storage.py
+import copy
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from storage import STORAGE_DB, write_behind
+
+logger = logging.getLogger(__name__)
+
+# Flows untouched for this long are treated as abandoned and dropped
+FSM_TTL = float(os.getenv("FSM_TTL", str(7 * 24 * 3600)))
+# Clean FSM entries kept in memory; dirty ones stay until they are flushed
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_PURGE_INTERVAL = float(os.getenv("FSM_PURGE_INTERVAL", "3600"))
+
+
+class SQLiteFSMStorage(BaseStorage):
+    """FSM storage persisted in the program database.
+
+    Hot entries live in a bounded LRU, changes are written in batches by the
+    storage write-behind task and entries expire after ``ttl`` seconds.
+    """
+
+    def __init__(self, path: str = STORAGE_DB, ttl: float = FSM_TTL, cache_size: int = FSM_CACHE_SIZE):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._writer = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA busy_timeout=5000")
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._writer.execute("CREATE INDEX IF NOT EXISTS fsm_updated_at ON fsm (updated_at)")
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # key -> [state, data, updated_at] (wall clock, so TTLs survive restarts)
+        self._cache: OrderedDict[str, list] = OrderedDict()
+        self._dirty: set = set()
+        self._last_purge = 0.0
+        self._closed = False
+
+    def _entry(self, key: StorageKey) -> list:
+        db_key = self.key_builder.build(key)
+        entry = self._cache.get(db_key)
+        if entry is None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT state, data, updated_at FROM fsm WHERE key = ?", (db_key,)
+                ).fetchone()
+            entry = [row[0], json.loads(row[1]), row[2]] if row else [None, {}, time.time()]
+            self._cache[db_key] = entry
+        if time.time() - entry[2] > self.ttl:
+            entry[:] = [None, {}, time.time()]
+            self._dirty.add(db_key)
+        self._cache.move_to_end(db_key)
+        self._evict()
+        return entry
+
+    def _evict(self):
+        excess = len(self._cache) - self.cache_size
+        if excess <= 0:
+            return
+        # Oldest entries first; dirty ones are skipped until they are flushed
+        for db_key in list(itertools.islice(self._cache, excess + len(self._dirty))):
+            if excess <= 0:
+                break
+            if db_key not in self._dirty:
+                del self._cache[db_key]
+                excess -= 1
+
+    def _changed(self, key: StorageKey, entry: list):
+        entry[2] = time.time()
+        self._dirty.add(self.key_builder.build(key))
+        if write_behind.running:
+            write_behind.notify()
+        else:
+            batch = self.collect()
+            self.write(batch)
+            self.commit(batch)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._changed(key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._entry(key)[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = self._entry(key)
+        entry[1] = copy.deepcopy(dict(data))
+        self._changed(key, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return copy.deepcopy(self._entry(key)[1])
+
+    # write-behind store protocol (see storage.WriteBehind)
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def changed(self) -> int:
+        return len(self._dirty)
+
+    def collect(self):
+        upserts, deletes = [], []
+        for db_key in self._dirty:
+            entry = self._cache.get(db_key)
+            if entry is None:
+                continue
+            state, data, updated_at = entry
+            if state is None and not data:
+                deletes.append((db_key,))
+            else:
+                try:
+                    upserts.append((db_key, state, json.dumps(data, ensure_ascii=False), updated_at))
+                except (TypeError, ValueError) as e:
+                    # Not re-queued: the same data would fail every flush
+                    logger.error("Cannot save FSM entry %s, data is not serializable: %s", db_key, e)
+        self._dirty.clear()
+        purge_before = None
+        if time.time() - self._last_purge > FSM_PURGE_INTERVAL:
+            self._last_purge = time.time()
+            purge_before = self._last_purge - self.ttl
+        return upserts, deletes, purge_before
+
+    def write(self, batch):
+        upserts, deletes, purge_before = batch
+        with self._write_lock:
+            self._writer.execute("BEGIN")
+            try:
+                self._writer.executemany("INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?)", upserts)
+                self._writer.executemany("DELETE FROM fsm WHERE key = ?", deletes)
+                if purge_before is not None:
+                    purged = self._writer.execute("DELETE FROM fsm WHERE updated_at < ?", (purge_before,)).rowcount
+                    if purged:
+                        logger.info(f"Purged {purged} abandoned FSM entries")
+                self._writer.execute("COMMIT")
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+
+    def commit(self, batch) -> int:
+        upserts, deletes, _ = batch
+        self._evict()
+        return len(upserts) + len(deletes)
+
+    def restore(self, batch):
+        upserts, deletes, _ = batch
+        self._dirty.update(row[0] for row in upserts)
+        self._dirty.update(row[0] for row in deletes)
+
+    async def close(self) -> None:
+        # Called from the dispatcher's shutdown, before the final write-behind flush
+        if self._closed:
+            return
+        if write_behind.running:
+            await write_behind.flush()
+        else:
+            batch = self.collect()
+            self.write(batch)
+            self.commit(batch)
+        write_behind.stores.remove(self)
+        self._closed = True
+        with self._write_lock:
+            self._writer.close()
+        with self._lock:
+            self._conn.close()
+
+
+fsm_storage = SQLiteFSMStorage()
+write_behind.add_store(fsm_storage)
@@ -0,0 +1,39 @@
+# keyboards.py
+"""Keyboards from settings.markups built once and reused.
+
+The markups never change at runtime, so every handler can share one
+instance instead of rebuilding the buttons on each update.
+"""
+import functools
+
+from aiogram.types import InlineKeyboardMarkup
+
+import settings.markups as nav
+
+
+@functools.lru_cache(maxsize=None)
+def days_keyboard() -> InlineKeyboardMarkup:
+    return nav.get_days_keyboard()
+
+
+# Keyed by the day count from callback data, so bounded
+@functools.lru_cache(maxsize=16)
+def program_keyboard(days) -> InlineKeyboardMarkup:
+    return nav.get_program_keyboard(days)
+
+
+@functools.lru_cache(maxsize=None)
+def channel_btn() -> InlineKeyboardMarkup:
+    return nav.get_channel_btn()
+
+
+@functools.lru_cache(maxsize=None)
+def tutorials_btn() -> InlineKeyboardMarkup:
+    return nav.get_tutorials_btn()
+
+
+def warm_keyboards():
+    """Build the keyboards ahead of the first update."""
+    days_keyboard()
+    channel_btn()
+    tutorials_btn()
@@ -0,0 +1,146 @@
+# layout.py
+"""Split rendered HTML into send-ready Telegram messages.
+
+Telegram limits a message to 4096 characters of its text after HTML parsing,
+counted in UTF-16 code units: tags don't count, an entity like ``&amp;``
+counts as one character and an emoji outside the BMP counts as two. Chunks
+break at line ends where possible and never inside a tag or entity; tags open
+at a break are closed at the end of the chunk and reopened in the next one.
+"""
+import html
+import json
+import logging
+import re
+from typing import List, Optional, Tuple
+
+from render import render_program, sequences_digest
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+# Part of the stored chunks' digest: bump when render.py or this module change the output
+LAYOUT_VERSION = "2"
+
+# Tags, entities, newlines, whitespace runs and words (long words in pieces)
+TOKEN_RE = re.compile(r"<[^>]*>|&#?\w+;|\n|[^\S\n]+|[^\s<&]{1,1000}|[<&]")
+TAG_RE = re.compile(r"<\s*(/)?\s*([a-zA-Z][\w-]*)")
+
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _visible_len(token: str) -> int:
+    if token.startswith("<") and TAG_RE.match(token):
+        return 0
+    if token.startswith("&") and token.endswith(";"):
+        return utf16_len(html.unescape(token))
+    return utf16_len(token)
+
+
+def _tokens(text: str, limit: int):
+    for token in TOKEN_RE.findall(text):
+        if not token.startswith(("<", "&")) and utf16_len(token) > limit:
+            # A word longer than a whole message; a piece of limit // 2 code points always fits
+            step = max(1, limit // 2)
+            yield from (token[i:i + step] for i in range(0, len(token), step))
+        else:
+            yield token
+
+
+def _has_text(tokens: List[str]) -> bool:
+    return any(_visible_len(token) and not token.isspace() for token in tokens)
+
+
+def _update_stack(stack: List[Tuple[str, str]], token: str):
+    match = TAG_RE.match(token)
+    if match is None:
+        return
+    closing, name = match.groups()
+    name = name.lower()
+    if not closing:
+        stack.append((name, token))
+        return
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i][0] == name:
+            del stack[i:]
+            return
+
+
+def _close(stack: List[Tuple[str, str]]) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+
+def _reopen(stack: List[Tuple[str, str]]) -> str:
+    return "".join(raw for _, raw in stack)
+
+
+def split_html(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Greedy split of ``text`` into the fewest chunks of at most ``limit`` UTF-16 units."""
+    if utf16_len(text) <= limit:
+        return [text]
+    chunks: List[str] = []
+    tokens: List[str] = []
+    size = 0
+    stack: List[Tuple[str, str]] = []
+    start_stack: List[Tuple[str, str]] = []
+    # Whitespace break points in ``tokens``: (index, open tags there, is newline)
+    breaks: List[Tuple[int, list, bool]] = []
+
+    def push(token: str):
+        nonlocal size
+        if token.isspace() and tokens:
+            breaks.append((len(tokens), list(stack), token == "\n"))
+        tokens.append(token)
+        size += _visible_len(token)
+        _update_stack(stack, token)
+
+    for token in _tokens(text, limit):
+        length = _visible_len(token)
+        if token.isspace() and tokens and size + length > limit:
+            # The text so far fills the chunk exactly; break on this whitespace
+            if _has_text(tokens):
+                chunks.append(_reopen(start_stack) + "".join(tokens).strip() + _close(stack))
+            tokens, size, breaks, start_stack = [], 0, [], list(stack)
+            continue
+        while tokens and size + length > limit:
+            # Prefer the last line end, then the last space, else cut right here
+            candidates = [b for b in breaks if b[2]] or breaks
+            index, break_stack = (candidates[-1][:2] if candidates else (len(tokens), list(stack)))
+            if _has_text(tokens[:index]):
+                chunks.append(_reopen(start_stack) + "".join(tokens[:index]).strip() + _close(break_stack))
+            rest = tokens[index:]
+            if rest and rest[0].isspace():
+                rest = rest[1:]
+            tokens, size, breaks, stack, start_stack = [], 0, [], list(break_stack), list(break_stack)
+            for rest_token in rest:
+                push(rest_token)
+        push(token)
+    if _has_text(tokens):
+        chunks.append(_reopen(start_stack) + "".join(tokens).strip() + _close(stack))
+    return chunks
+
+
+def program_chunks(program: dict, limit: int = MESSAGE_LIMIT) -> Optional[List[str]]:
+    """Send-ready messages for a stored program: each day split into as few chunks as fit."""
+    messages = render_program(program)
+    if messages is None:
+        return None
+    return [chunk for message in messages for chunk in split_html(message, limit)]
+
+
+def layout_version() -> str:
+    """LAYOUT_VERSION plus a digest of the muscle sequences the layouts are built from."""
+    return f"{LAYOUT_VERSION}:{sequences_digest()}"
+
+
+def encode_chunks(program) -> Optional[str]:
+    """Storage renderer: JSON list of chunks, or None for records that aren't programs."""
+    if not isinstance(program, dict) or not program.get("program"):
+        return None
+    try:
+        chunks = program_chunks(program)
+    except Exception as e:
+        logger.warning("Could not lay out program: %s", e)
+        return None
+    return json.dumps(chunks, ensure_ascii=False) if chunks else None
@@ -0,0 +1,48 @@
+# loader.py
+import os
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.enums import ParseMode
+
+import settings.config as cfg
+
+BOT_POOL_SIZE = int(os.getenv("BOT_POOL_SIZE", "100"))
+BOT_KEEPALIVE = float(os.getenv("BOT_KEEPALIVE", "60"))
+BOT_DNS_TTL = int(os.getenv("BOT_DNS_TTL", "3600"))
+BOT_REQUEST_TIMEOUT = float(os.getenv("BOT_REQUEST_TIMEOUT", "30"))
+
+
+class PooledAiohttpSession(AiohttpSession):
+    """AiohttpSession whose TCPConnector also gets ``connector_kwargs``.
+
+    AiohttpSession only exposes ``limit``; it builds the connector from
+    ``_connector_init`` on first request, so that attribute is the one place
+    this relies on aiogram internals (the version is pinned in requirements.txt).
+    """
+
+    def __init__(self, limit: int = 100, connector_kwargs: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        super().__init__(limit=limit, **kwargs)
+        self._connector_init.update(connector_kwargs or {})
+
+
+def create_session() -> AiohttpSession:
+    """One pooled aiohttp session for every Bot API call the process makes."""
+    return PooledAiohttpSession(
+        limit=BOT_POOL_SIZE,
+        timeout=BOT_REQUEST_TIMEOUT,
+        connector_kwargs={"ttl_dns_cache": BOT_DNS_TTL, "keepalive_timeout": BOT_KEEPALIVE},
+    )
+
+
+bot = Bot(
+    token=cfg.BOT_TOKEN,
+    session=create_session(),
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
+
+
+async def close_bot():
+    await bot.session.close()
@@ -1,195 +1,93 @@
 
+import startup  # first: timestamps the start of imports
+
 import logging
 import asyncio
+import json
+import os
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.filters import Command
-from aiogram.enums import ParseMode, ContentType
-from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ContentType
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.types import ReplyKeyboardRemove, LabeledPrice, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.types import ReplyKeyboardRemove, LabeledPrice, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram import F
 
-from handlers.prog_fullbody2 import register_fullbody2_handlers, muscle_sequence as fullbody_sequence
-from handlers.prog_fullbody3 import register_fullbody3_handlers
-from handlers.prog_hybrid3 import register_hybrid3_handlers, muscle_sequence_day1, muscle_sequence_day2, muscle_sequence_day3
-from handlers.prog_upperlower2 import register_upperlower2_handlers, muscle_sequence_day1 as ul_day1, muscle_sequence_day2 as ul_day2, muscle_sequence_day3 as ul_day3, muscle_sequence_day4 as ul_day4
-from handlers.prog_ap2 import register_pushpull2_handlers, muscle_sequence_day1 as ap_day1, muscle_sequence_day2 as ap_day2
-import settings.markups as nav
 import settings.config as cfg
-from utils import check_sub, are_markups_equal
-from storage import user_program
+import keyboards
+from loader import bot, close_bot
+from utils import check_sub, sub_cache, render_fingerprint, render_state
+from storage import user_program, write_behind
+from fsm_storage import fsm_storage
+from render import render_cache
+from layout import encode_chunks, layout_version, program_chunks
+from media import answer_cached_photo, media_cache
+from sender import outbound
+from webhook import run_webhook
+from metrics import registry, start_metrics_server
+from middlewares import (
+    UPDATE_MAX_CONCURRENT, UserSerializationMiddleware, setup_metrics_middlewares, setup_startup_middleware,
+    setup_user_serialization,
+)
 
-logging.basicConfig(level=logging.DEBUG)
+# Production runs at INFO; hot-path debug messages are formatted lazily
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), force=True)
 logger = logging.getLogger(__name__)
 
-bot = Bot(
-    token=cfg.BOT_TOKEN,
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-)
-dp = Dispatcher()
+# "polling" or "webhook" (see webhook.py for its settings)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
 
-async def send_split_message(bot, chat_id: int, text: str, reply_markup=None):
-    MAX_MESSAGE_LENGTH = 4000
-    logger.debug(f"Sending message to chat {chat_id}, length: {len(text)}")
-    if len(text) <= MAX_MESSAGE_LENGTH:
-        await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-        return
-    lines = text.split("\n")
-    current_chunk = ""
-    for line in lines:
-        if len(current_chunk) + len(line) + 1 > MAX_MESSAGE_LENGTH:
-            logger.debug(f"Sending chunk of length {len(current_chunk.strip())} for chat {chat_id}")
-            await bot.send_message(chat_id=chat_id, text=current_chunk.strip())
-            current_chunk = ""
-        current_chunk += line + "\n"
-    if current_chunk.strip():
-        logger.debug(f"Sending final chunk of length {len(current_chunk.strip())} for chat {chat_id}")
-        await bot.send_message(chat_id=chat_id, text=current_chunk.strip(), reply_markup=reply_markup)
-
-async def format_day(day_num: int, day_name: str, exercises: list, muscle_seq: list, sets_reps: str, is_multi_day: bool = True):
-    prefix = f"{day_num}️⃣ <b>День {day_num} ({day_name})</b>\n" if is_multi_day else ""
-    day_text = prefix
-    muscle_groups = {}
-    subgroup_to_group = {}
-    nested_subgroups = {"Квадрицепсы": [], "Бицепс бедра": []}
-    for group, subgroup, count in muscle_seq:
-        if isinstance(count, list):
-            for sub_subgroup, _ in count:
-                subgroup_to_group[sub_subgroup] = group
-                nested_subgroups[subgroup].append(sub_subgroup)
-        else:
-            subgroup_to_group[subgroup] = group
-    for exercise in exercises:
-        try:
-            subgroup, exercise_name = exercise.split(": ", 1)
-            muscle_group = subgroup_to_group.get(subgroup, "Прочее")
-            if muscle_group not in muscle_groups:
-                muscle_groups[muscle_group] = {}
-            if subgroup not in muscle_groups[muscle_group]:
-                muscle_groups[muscle_group][subgroup] = []
-            muscle_groups[muscle_group][subgroup].append(exercise_name)
-        except ValueError:
-            logger.warning(f"Invalid exercise format: {exercise}")
-            muscle_group = "Прочее"
-            if muscle_group not in muscle_groups:
-                muscle_groups[muscle_group] = {}
-            if "Неизвестная группа" not in muscle_groups[muscle_group]:
-                muscle_groups[muscle_group]["Неизвестная группа"] = []
-            muscle_groups[muscle_group]["Неизвестная группа"].append(exercise)
-    for muscle_group in muscle_groups:
-        day_text += f"\n💪 <b>{muscle_group}</b>\n"
-        if muscle_group == "Ноги" and is_multi_day:
-            for parent_subgroup in ["Квадрицепсы", "Бицепс бедра"]:
-                if any(sub in muscle_groups[muscle_group] for sub in nested_subgroups[parent_subgroup]):
-                    day_text += f"  ➡️ <b><i>{parent_subgroup}</i></b>\n"
-                    for subgroup in sorted(nested_subgroups[parent_subgroup]):
-                        if subgroup in muscle_groups[muscle_group]:
-                            day_text += f"    ➡️ <b><i>{subgroup}</i></b>\n"
-                            for exercise in muscle_groups[muscle_group][subgroup]:
-                                day_text += f"      • {exercise} ({sets_reps})\n"
-            other_subgroups = [sub for sub in muscle_groups[muscle_group] if sub not in sum(nested_subgroups.values(), [])]
-            for subgroup in sorted(other_subgroups):
-                day_text += f"  ➡️ <b><i>{subgroup}</i></b>\n"
-                for exercise in muscle_groups[muscle_group][subgroup]:
-                    day_text += f"    • {exercise} ({sets_reps})\n"
-        else:
-            for subgroup in sorted(muscle_groups[muscle_group].keys()):
-                day_text += f"  ➡️ <b><i>{subgroup}</i></b>\n"
-                for exercise in muscle_groups[muscle_group][subgroup]:
-                    day_text += f"    • {exercise} ({sets_reps})\n"
-    logger.debug(f"Formatted day {day_num} ({day_name}) text length: {len(day_text)}")
-    return day_text
+dp = Dispatcher(storage=fsm_storage)
+# Saving a program also stores its send-ready message chunks; editing a
+# muscle sequence in handlers/* changes the version and re-renders them
+user_program.set_renderer(encode_chunks, layout_version)
+# One update per user at a time, so double taps can't interleave program/FSM changes
+update_serializer = UserSerializationMiddleware()
+
+async def send_chunks(bot, chat_id: int, chunks: list, reply_markup=None):
+    """Queue all chunks at once; the per-chat queue keeps their order. Markup goes on the last one."""
+    logger.debug("Sending %d chunks to chat %s", len(chunks), chat_id)
+    await asyncio.gather(*(
+        outbound.send_message(bot, chat_id, chunk, reply_markup=reply_markup if idx == len(chunks) - 1 else None)
+        for idx, chunk in enumerate(chunks)
+    ))
 
 async def display_program(message: types.Message, user_id: str, first_name: str) -> bool:
-    logger.debug(f"Checking user_program for user {user_id}: {user_program.get(user_id)}")
     if user_id not in user_program or not user_program[user_id].get("program"):
-        logger.info(f"No program found for user {user_id}")
+        logger.info("No program found for user %s", user_id)
         return False
 
     program = user_program[user_id]
-    days = program.get('days', 2)
-    sets_reps = program.get('sets_reps', '3 подхода, 3-8 повторений')
     program_type = program.get('type', 'Unknown')
-    logger.info(f"Displaying program for user {user_id}: type={program_type}, days={days}")
-
-    intro_text = (
-        "😲 Отличный выбор упражнений, спортсмен, очень оптимальный выбор!\n\n"
-        "📝 <i>Упражнения не написаны по исполнительному порядку, начинай тренировку с мышцы, "
-        "которую ты хочешь акцентировать сегодня, и после переходи на следующие упражнения по своему выбору.</i>\n"
-        "💡 <i>Если ты хочешь постепенно добавлять объем, добавляй! Но только если твое тело это позволяет, не нагружай себя просто так.</i>\n\n"
-        f"🏋️ <b>Ваша программа тренировок</b>\n"
-        f"📅 Тип: {program_type}\n"
-        f"🗓 Дней: {days}\n"
-    )
-    footer_text = (
-        "\n💡 Техника: <a href='https://t.me/+IkIXHNQL3vgyYzQ8'>ТуторыЗамены</a>\n"
-        "📋 Просмотр: /programma\n"
-        "🔥 Удачи!"
-    )
+    logger.info("Displaying program for user %s: type=%s, days=%s", user_id, program_type, program.get('days', 2))
+
+    # Chunks laid out when the program was saved; older records are laid out here once
+    stored = user_program.rendered(user_id)
+    chunks = json.loads(stored) if stored is not None else program_chunks(program)
+    if chunks is None:
+        logger.warning("Invalid program structure for user %s: %s", user_id, program)
+        return False
+
     markup = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔄 Пересоставить", callback_data="clear_program")]
     ])
-
-    # Handle FullBody programs (list-based)
-    if isinstance(program["program"], list) and program_type in ["FullBody 2.0", "FullBody 3.0"]:
-        response = intro_text + f"ℹ️ <i>Программа одинакова для всех дней тренировок.</i>\n\n<b>Упражнения:</b>\n"
-        day_text = await format_day(1, "", program["program"], fullbody_sequence, sets_reps, is_multi_day=False)
-        response += day_text
-        await send_split_message(bot, message.chat.id, response + footer_text, reply_markup=markup)
-        logger.info(f"Displayed {program_type} program for user {user_id}")
-        return True
-
-    # Handle multi-day programs (dict-based)
-    if isinstance(program["program"], dict):
-        if program_type == "3 day гибрид верх/низа и фулбади":
-            days_config = [
-                (1, "Фулбади", program["program"]["day1"], muscle_sequence_day1),
-                (2, "Верх", program["program"]["day2"], muscle_sequence_day2),
-                (3, "Низ", program["program"]["day3"], muscle_sequence_day3)
-            ]
-        elif program_type == "4 day верх/низ":
-            days_config = [
-                (1, "Верх", program["program"]["day1"], ul_day1),
-                (2, "Низ", program["program"]["day2"], ul_day2),
-                (3, "Верх", program["program"]["day3"], ul_day3),
-                (4, "Низ", program["program"]["day4"], ul_day4)
-            ]
-        elif program_type == "4 day перед/зад":
-            days_config = [
-                (1, "Перед", program["program"]["day1"], ap_day1),
-                (2, "Зад", program["program"]["day2"], ap_day2),
-                (3, "Перед", program["program"]["day3"], ap_day1),
-                (4, "Зад", program["program"]["day4"], ap_day2)
-            ]
-        else:
-            logger.warning(f"Unknown dict-based program type: {program_type} for user {user_id}")
-            return False
-
-        for idx, (day_num, day_name, exercises, muscle_seq) in enumerate(days_config):
-            day_text = await format_day(day_num, day_name, exercises, muscle_seq, sets_reps)
-            text = (intro_text + "\n" + day_text) if idx == 0 else day_text
-            reply_markup = markup if idx == len(days_config) - 1 else None
-            footer = footer_text if idx == len(days_config) - 1 else ""
-            await send_split_message(bot, message.chat.id, text + footer, reply_markup=reply_markup)
-        logger.info(f"Displayed {program_type} program for user {user_id}")
-        return True
-
-    logger.warning(f"Invalid program structure for user {user_id}: {program}")
-    return False
+    await send_chunks(bot, message.chat.id, chunks, reply_markup=markup)
+    logger.info("Displayed %s program for user %s", program_type, user_id)
+    return True
 
 @dp.message(Command("tutorials"))
 async def tutorials_cmd(message: types.Message):
-    await message.answer_photo(
-        photo=FSInputFile(cfg.tutorials_image),
+    await answer_cached_photo(
+        message,
+        cfg.tutorials_image,
         caption=(
             "🎥 <b>Туторы и замены упражнений</b>\n"
             "Ознакомьтесь с техникой на нашем канале:\n"
             "<a href='https://t.me/+IkIXHNQL3vgyYzQ8'>ТуторыЗамены</a>"
         ),
-        reply_markup=nav.get_tutorials_btn()
+        reply_markup=keyboards.tutorials_btn()
     )
 
 class DonateStates(StatesGroup):
@@ -200,8 +98,9 @@ async def donate_cmd(message: types.Message, state: FSMContext):
     markup = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_donate")]
     ])
-    await message.answer_photo(
-        photo=FSInputFile(cfg.donate_image),
+    await answer_cached_photo(
+        message,
+        cfg.donate_image,
         caption=(
             "💸 <b>Поддержите проект!</b>\n"
             "Введите количество ⭐️ для пожертвования (целое число):"
@@ -231,7 +130,7 @@ async def process_amount(message: types.Message, state: FSMContext):
         )
         await state.clear()
     except TelegramBadRequest as e:
-        logger.error(f"Error sending invoice: {e}")
+        logger.error("Error sending invoice: %s", e)
         await message.answer("❌ Ошибка при создания платежа. Попробуйте позже.")
 
 @dp.callback_query(F.data == "cancel_donate")
@@ -239,7 +138,7 @@ async def cancel_donate_callback(callback: types.CallbackQuery, state: FSMContex
     try:
         await callback.message.delete()
     except TelegramBadRequest as e:
-        logger.warning(f"Failed to delete message: {e}")
+        logger.warning("Failed to delete message: %s", e)
 
     await callback.message.answer("❌ Пожертвование отменено.\n💪 Что дальше? /programma")
     await state.clear()
@@ -250,7 +149,7 @@ async def checkout(pre_q: types.PreCheckoutQuery):
     try:
         await bot.answer_pre_checkout_query(pre_q.id, ok=True)
     except Exception as e:
-        logger.error(f"Error in pre-checkout: {e}")
+        logger.error("Error in pre-checkout: %s", e)
         await bot.answer_pre_checkout_query(pre_q.id, ok=False, error_message="Payment error")
 
 @dp.message(F.content_type == ContentType.SUCCESSFUL_PAYMENT)
@@ -267,8 +166,13 @@ async def check_subscription_handler(callback: types.CallbackQuery):
     user_id = str(callback.from_user.id)
     first_name = callback.from_user.first_name or "User"
 
-    is_subscribed = await check_sub(cfg.CHANNEL, user_id)
-    logger.info(f"User {user_id} subscription check result: {is_subscribed}")
+    if render_state.debounce(user_id):
+        logger.debug("Debounced subscription check for user %s", user_id)
+        await callback.answer()
+        return
+
+    is_subscribed = await check_sub(cfg.CHANNEL, user_id, force=True)
+    logger.info("User %s subscription check result: %s", user_id, is_subscribed)
 
     if is_subscribed:
         text = (
@@ -285,29 +189,30 @@ async def check_subscription_handler(callback: types.CallbackQuery):
             f"{cfg.NOT_SUB_MESS}\n"
             "После подписки нажми 'Проверить подписку'."
         )
-        markup = nav.get_channel_btn()
-
-    current_text = callback.message.text or ""
-    current_markup = callback.message.reply_markup
-
-    markup_equal = are_markups_equal(markup, current_markup)
-    logger.debug(f"Text changed: {text != current_text}, Markup equal: {markup_equal}")
+        markup = keyboards.channel_btn()
 
-    if text != current_text or not markup_equal:
+    message = callback.message
+    fingerprint = render_fingerprint(text, markup)
+    if render_state.is_current(message, fingerprint):
+        logger.debug("Skipped edit for user %s: message already up to date", user_id)
+    else:
         try:
-            if callback.message.text:
-                await callback.message.edit_text(text, reply_markup=markup)
-            elif callback.message.caption:
-                await callback.message.edit_caption(caption=text, reply_markup=markup)
+            if message.text:
+                result = await message.edit_text(text, reply_markup=markup)
+            elif message.caption:
+                result = await message.edit_caption(caption=text, reply_markup=markup)
             else:
-                await callback.message.answer(text, reply_markup=markup)
+                result = await message.answer(text, reply_markup=markup)
+            if isinstance(result, types.Message):
+                render_state.remember(result, fingerprint)
         except TelegramBadRequest as e:
             if "message is not modified" in str(e):
-                logger.debug(f"Skipped edit for user {user_id}: message not modified")
+                logger.debug("Skipped edit for user %s: message not modified", user_id)
+                render_state.remember(message, fingerprint, edited=False)
             else:
-                logger.warning(f"Error editing message for user {user_id}: {e}")
+                logger.warning("Error editing message for user %s: %s", user_id, e)
         except Exception as e:
-            logger.warning(f"Unexpected error editing message for user {user_id}: {e}")
+            logger.warning("Unexpected error editing message for user %s: %s", user_id, e)
     await callback.answer()
 
 @dp.callback_query(F.data == "start_programma")
@@ -315,7 +220,7 @@ async def start_programma_callback(callback: types.CallbackQuery, state: FSMCont
     user_id = str(callback.from_user.id)
     first_name = callback.from_user.first_name or "User"
 
-    logger.info(f"Start programma callback for user {user_id}")
+    logger.info("Start programma callback for user %s", user_id)
 
     if not await check_sub(cfg.CHANNEL, user_id):
         await callback.message.edit_caption(
@@ -323,7 +228,7 @@ async def start_programma_callback(callback: types.CallbackQuery, state: FSMCont
                 f"❗ <b>{first_name}, подпишись на каналы!</b>\n"
                 f"{cfg.NOT_SUB_MESS}"
             ),
-            reply_markup=nav.get_channel_btn()
+            reply_markup=keyboards.channel_btn()
         )
         await callback.answer()
         return
@@ -335,7 +240,7 @@ async def start_programma_callback(callback: types.CallbackQuery, state: FSMCont
     await callback.message.answer(
         "🏋️ <b>Создаем программу!</b>\n"
         "Сколько дней в неделю ты готов тренироваться?",
-        reply_markup=nav.get_days_keyboard()
+        reply_markup=keyboards.days_keyboard()
     )
     await state.set_state(TrainingProgramStates.choosing_days)
     await callback.answer()
@@ -344,12 +249,13 @@ async def start_programma_callback(callback: types.CallbackQuery, state: FSMCont
 async def start_cmd(message: types.Message, state: FSMContext):
     user_id = str(message.from_user.id)
     first_name = message.from_user.first_name or "User"
-    logger.info(f"Start command received for user {user_id}")
+    logger.info("Start command received for user %s", user_id)
 
     if message.chat.type == "private":
         if await check_sub(cfg.CHANNEL, user_id):
-            await message.answer_photo(
-                photo=FSInputFile(cfg.start_image),
+            await answer_cached_photo(
+                message,
+                cfg.start_image,
                 caption=(
                     f"👋 <b>Привет, {first_name}!</b>\n"
                     f"{cfg.START_MESS_SUB}\n"
@@ -360,13 +266,14 @@ async def start_cmd(message: types.Message, state: FSMContext):
                 ])
             )
         else:
-            await message.answer_photo(
-                photo=FSInputFile(cfg.start_image),
+            await answer_cached_photo(
+                message,
+                cfg.start_image,
                 caption=(
                     f"❗ <b>Привет, {first_name}!</b>\n"
                     f"{cfg.NOT_SUB_MESS}"
                 ),
-                reply_markup=nav.get_channel_btn()
+                reply_markup=keyboards.channel_btn()
             )
 
 class TrainingProgramStates(StatesGroup):
@@ -378,27 +285,28 @@ async def programma_cmd(message: types.Message, state: FSMContext):
     user_id = str(message.from_user.id)
     first_name = message.from_user.first_name or "User"
 
-    logger.info(f"Programma command for user {user_id}: {user_program.get(user_id)}")
+    logger.info("Programma command for user %s", user_id)
 
     if not await check_sub(cfg.CHANNEL, user_id):
-        await message.answer_photo(
-            photo=FSInputFile(cfg.start_image),
+        await answer_cached_photo(
+            message,
+            cfg.start_image,
             caption=(
                 f"❗ <b>{first_name}, подпишись на каналы!</b>\n"
                 f"{cfg.NOT_SUB_MESS}"
             ),
-            reply_markup=nav.get_channel_btn()
+            reply_markup=keyboards.channel_btn()
         )
         return
 
     if await display_program(message, user_id, first_name):
         return
 
-    logger.info(f"No valid program found for user {user_id}, proceeding to day selection")
+    logger.info("No valid program found for user %s, proceeding to day selection", user_id)
     await message.answer(
         "🏋️ <b>Создаем программу!</b>\n"
         "Сколько дней в неделю ты готов тренироваться?",
-        reply_markup=nav.get_days_keyboard()
+        reply_markup=keyboards.days_keyboard()
     )
     await state.set_state(TrainingProgramStates.choosing_days)
 
@@ -410,7 +318,7 @@ async def handle_days_selection(callback: types.CallbackQuery, state: FSMContext
     await callback.message.edit_text(
         f"✅ <b>Вы выбрали {days} дня(дней)</b>\n"
         "Теперь выберите тип программы:",
-        reply_markup=nav.get_program_keyboard(days)
+        reply_markup=keyboards.program_keyboard(days)
     )
     await state.set_state(TrainingProgramStates.choosing_program)
     await callback.answer()
@@ -420,17 +328,63 @@ async def handle_back_to_days(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(TrainingProgramStates.choosing_days)
     await callback.message.edit_text(
         "🏋️ <b>Сколько дней в неделю?</b>",
-        reply_markup=nav.get_days_keyboard()
+        reply_markup=keyboards.days_keyboard()
     )
     await callback.answer()
 
-async def main():
+def setup_dispatcher():
+    # Imported here rather than at module level so importing main stays cheap
+    from handlers.prog_fullbody2 import register_fullbody2_handlers
+    from handlers.prog_fullbody3 import register_fullbody3_handlers
+    from handlers.prog_hybrid3 import register_hybrid3_handlers
+    from handlers.prog_upperlower2 import register_upperlower2_handlers
+    from handlers.prog_ap2 import register_pushpull2_handlers
+
+    startup.mark("imports")
     register_fullbody2_handlers(dp)
     register_fullbody3_handlers(dp)
     register_hybrid3_handlers(dp)
     register_upperlower2_handlers(dp)
     register_pushpull2_handlers(dp)
-    await dp.start_polling(bot)
+    setup_user_serialization(dp, update_serializer)
+    setup_metrics_middlewares(dp, bot)
+    setup_startup_middleware(dp)
+    keyboards.warm_keyboards()
+    startup.mark("dispatcher")
+
+def register_stats_collectors():
+    registry.add_stats("bot_storage", write_behind.stats,
+                       counters=("flush_count", "records_written", "total_flush_seconds"))
+    registry.add_stats("bot_user_program", user_program.memory_stats)
+    registry.add_stats("bot_sub_cache", sub_cache.stats, counters=("hits", "misses", "coalesced"))
+    registry.add_stats("bot_render_state", render_state.stats, counters=("edits", "avoided", "debounced"))
+    registry.add_stats("bot_render_cache", render_cache.stats, counters=("hits", "misses"))
+    registry.add_stats("bot_media_cache", media_cache.stats, counters=("hits", "uploads"))
+    registry.add_stats("bot_outbound", outbound.stats, counters=("sent", "failed", "retries"))
+    registry.add_stats("bot_startup_seconds", startup.stats)
+    registry.add_stats("bot_updates", update_serializer.stats, counters=("duplicates", "overflow"))
+
+async def main():
+    setup_dispatcher()
+    register_stats_collectors()
+    metrics_runner = await start_metrics_server()
+    await write_behind.start()
+    # Fills the idle-user cache while the bot already serves updates
+    warmup = asyncio.create_task(user_program.warm_up())
+    startup.mark("storage")
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            # Polling stops fetching while this many updates are being handled
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_MAX_CONCURRENT)
+    finally:
+        warmup.cancel()
+        await outbound.drain(timeout=10)
+        await write_behind.stop()
+        await close_bot()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,99 @@
+# media.py
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+from storage import STORAGE_DB
+
+logger = logging.getLogger(__name__)
+
+# Fragments of Bot API errors meaning a stored file_id can no longer be used
+INVALID_FILE_ERRORS = ("wrong file identifier", "wrong remote file", "file_id_invalid", "file reference")
+
+
+class MediaCache:
+    """Remembers the file_id Telegram returns for each uploaded local file.
+
+    Entries are keyed by path and invalidated when the file's size or mtime
+    changes, so replacing an image on disk triggers a fresh upload.
+    """
+
+    def __init__(self, path: str = STORAGE_DB):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS media_cache (path TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, file_id TEXT NOT NULL)"
+        )
+        self._entries: Dict[str, Tuple[str, str]] = {
+            path: (fingerprint, file_id)
+            for path, fingerprint, file_id in self._conn.execute("SELECT path, fingerprint, file_id FROM media_cache")
+        }
+        self._upload_locks: Dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.uploads = 0
+
+    @staticmethod
+    def _fingerprint(path: str) -> str:
+        st = os.stat(path)
+        return f"{st.st_size}:{st.st_mtime_ns}"
+
+    def get(self, path: str) -> Optional[str]:
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != self._fingerprint(path):
+            return None
+        return entry[1]
+
+    def remember(self, path: str, file_id: str):
+        fingerprint = self._fingerprint(path)
+        self._entries[path] = (fingerprint, file_id)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO media_cache VALUES (?, ?, ?)", (path, fingerprint, file_id))
+
+    def forget(self, path: str):
+        self._entries.pop(path, None)
+        with self._lock:
+            self._conn.execute("DELETE FROM media_cache WHERE path = ?", (path,))
+
+    def upload_lock(self, path: str) -> asyncio.Lock:
+        return self._upload_locks.setdefault(path, asyncio.Lock())
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "uploads": self.uploads}
+
+
+media_cache = MediaCache()
+
+
+async def answer_cached_photo(message: types.Message, path: str, **kwargs) -> types.Message:
+    """message.answer_photo for a local file, reusing its file_id after the first upload."""
+    file_id = media_cache.get(path)
+    if file_id is not None:
+        try:
+            sent = await message.answer_photo(photo=file_id, **kwargs)
+            media_cache.hits += 1
+            return sent
+        except TelegramBadRequest as e:
+            if not any(fragment in str(e).lower() for fragment in INVALID_FILE_ERRORS):
+                raise
+            logger.warning(f"Cached file_id for {path} rejected ({e}), uploading again")
+            media_cache.forget(path)
+
+    # Only one upload per file at a time; the others reuse its file_id
+    async with media_cache.upload_lock(path):
+        file_id = media_cache.get(path)
+        if file_id is not None:
+            media_cache.hits += 1
+            return await message.answer_photo(photo=file_id, **kwargs)
+        sent = await message.answer_photo(photo=FSInputFile(path), **kwargs)
+        media_cache.uploads += 1
+        if sent.photo:
+            media_cache.remember(path, sent.photo[-1].file_id)
+        return sent
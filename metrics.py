@@ -0,0 +1,144 @@
+# metrics.py
+import bisect
+import logging
+import os
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 disables the endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (metric name, labels, value) triples produced by a collector at scrape time
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """In-process metrics rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.histograms: Dict[str, Dict[Tuple, Histogram]] = defaultdict(dict)
+        self.counters: Dict[str, Dict[Tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self.collectors: List[Tuple[str, Callable[[], Iterable[Sample]]]] = []
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        histogram = self.histograms[name].get(key)
+        if histogram is None:
+            histogram = self.histograms[name][key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str):
+        self.counters[name][tuple(sorted(labels.items()))] += amount
+
+    def add_collector(self, kind: str, collector: Callable[[], Iterable[Sample]]):
+        """Register a callable sampled on every scrape; ``kind`` is "gauge" or "counter"."""
+        self.collectors.append((kind, collector))
+
+    def add_stats(self, prefix: str, stats: Callable[[], Dict[str, float]], counters: Iterable[str] = (), **labels: str):
+        """Expose a ``stats()`` dict: ``counters`` fields as counters, the rest as gauges."""
+        counters = frozenset(counters)
+        self.add_collector("gauge", stats_collector(prefix, stats, counters, "gauge", **labels))
+        if counters:
+            self.add_collector("counter", stats_collector(prefix, stats, counters, "counter", **labels))
+
+    @staticmethod
+    def _labels(labels: Iterable[Tuple[str, str]], **extra: str) -> str:
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in items) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, series in self.histograms.items():
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, le=repr(bound))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, le='+Inf')} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for name, series in self.counters.items():
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in series.items():
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        typed = set()
+        for kind, collector in self.collectors:
+            try:
+                samples = list(collector())
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+                continue
+            for name, labels, value in samples:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name}{self._labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def stats_collector(prefix: str, stats: Callable[[], Dict[str, float]], counters: Iterable[str] = (),
+                    kind: str = "gauge", **labels: str) -> Callable[[], List[Sample]]:
+    """Numeric fields of a ``stats()`` dict of one ``kind``.
+
+    Gauges are the fields not in ``counters``, named ``<prefix>_<field>``;
+    counters are the ``counters`` fields, named ``<prefix>_<field>_total``.
+    """
+    counters = frozenset(counters)
+    want_counters = kind == "counter"
+    suffix = "_total" if want_counters else ""
+
+    def collect():
+        return [
+            (f"{prefix}_{field}{suffix}", labels, value)
+            for field, value in stats().items()
+            if isinstance(value, (int, float)) and (field in counters) == want_counters
+        ]
+    return collect
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Metrics are optional; a taken port must not keep the bot from starting
+        logger.error("Metrics endpoint disabled, cannot listen on %s:%s: %s", host, port, e)
+        await runner.cleanup()
+        return None
+    logger.info("Metrics endpoint on http://%s:%s/metrics", host, port)
+    return runner
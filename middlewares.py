@@ -0,0 +1,192 @@
+# middlewares.py
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject, Update
+
+import startup
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Updates handled at once across all users; the rest wait (polling stops fetching)
+UPDATE_MAX_CONCURRENT = int(os.getenv("UPDATE_MAX_CONCURRENT", "100"))
+# Updates of one user queued behind the one being handled; more are dropped
+USER_MAX_PENDING = int(os.getenv("USER_MAX_PENDING", "10"))
+# The same button on the same message pressed again within this window is dropped
+CALLBACK_DEDUPE_WINDOW = float(os.getenv("CALLBACK_DEDUPE_WINDOW", "1.0"))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Per-handler latency histogram and error counter (inner middleware)."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            registry.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            registry.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Bot API call counts, errors and latency by method."""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            registry.inc("bot_api_errors_total", method=name)
+            raise
+        finally:
+            registry.observe("bot_api_seconds", time.perf_counter() - started, method=name)
+
+
+class StartupMiddleware(BaseMiddleware):
+    """Marks the first handled update in the startup timeline."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            startup.first_update_handled()
+
+
+class UserSerializationMiddleware(BaseMiddleware):
+    """Handles one update per user at a time, in arrival order.
+
+    Per-user locks exist only while that user has updates in flight, so
+    their number is bounded by the queued updates. A global semaphore caps
+    concurrent handling, and repeated presses of the same callback button
+    within ``dedupe_window`` are answered and dropped.
+    """
+
+    def __init__(self, max_concurrent: int = UPDATE_MAX_CONCURRENT, max_pending: int = USER_MAX_PENDING,
+                 dedupe_window: float = CALLBACK_DEDUPE_WINDOW):
+        self.max_pending = max_pending
+        self.dedupe_window = dedupe_window
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        # user id -> [lock, updates holding or waiting for it]
+        self._users: Dict[int, list] = {}
+        self._recent_callbacks: OrderedDict[tuple, float] = OrderedDict()
+        self.in_flight = 0
+        self.duplicates = 0
+        self.overflow = 0
+
+    def _is_duplicate(self, update: Update) -> bool:
+        query = update.callback_query
+        if query is None or not self.dedupe_window:
+            return False
+        now = time.monotonic()
+        while self._recent_callbacks:
+            key, seen_at = next(iter(self._recent_callbacks.items()))
+            if now - seen_at <= self.dedupe_window:
+                break
+            del self._recent_callbacks[key]
+        message_id = query.message.message_id if query.message else query.inline_message_id
+        key = (query.from_user.id, message_id, query.data)
+        if key in self._recent_callbacks:
+            return True
+        self._recent_callbacks[key] = now
+        return False
+
+    async def _drop_callback(self, update: Update):
+        try:
+            await update.callback_query.answer()
+        except Exception as e:
+            logger.debug("Could not answer dropped callback %s: %s", update.callback_query.id, e)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        if isinstance(event, Update) and self._is_duplicate(event):
+            self.duplicates += 1
+            logger.debug("Dropped duplicate callback from user %s", user.id if user else None)
+            await self._drop_callback(event)
+            return None
+        if user is None:
+            return await self._handle(handler, event, data)
+        slot = self._users.get(user.id)
+        if slot is None:
+            slot = self._users[user.id] = [asyncio.Lock(), 0]
+        elif slot[1] > self.max_pending:
+            self.overflow += 1
+            logger.warning("Dropped update from user %s: %d updates already in flight", user.id, slot[1])
+            if isinstance(event, Update) and event.callback_query is not None:
+                await self._drop_callback(event)
+            return None
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                return await self._handle(handler, event, data)
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._users[user.id]
+
+    async def _handle(self, handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                return await handler(event, data)
+            finally:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "active_users": len(self._users),
+            "duplicates": self.duplicates,
+            "overflow": self.overflow,
+        }
+
+
+def setup_user_serialization(dp: Dispatcher, middleware: Optional[UserSerializationMiddleware] = None) -> UserSerializationMiddleware:
+    """Install ``middleware`` so it runs before FSM state is read for the update.
+
+    The dispatcher's FSM middleware loads the user's state up front, so it is
+    re-registered after this one; otherwise a queued update would see the state
+    from before the previous update finished.
+    """
+    middleware = middleware or UserSerializationMiddleware()
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(middleware)
+    dp.update.outer_middleware(dp.fsm)
+    return middleware
+
+
+def setup_startup_middleware(dp: Dispatcher):
+    dp.update.outer_middleware(StartupMiddleware())
+
+
+def setup_metrics_middlewares(dp: Dispatcher, bot: Bot):
+    handler_metrics = HandlerMetricsMiddleware()
+    for observer in (dp.message, dp.callback_query, dp.pre_checkout_query):
+        observer.middleware(handler_metrics)
+    bot.session.middleware(ApiMetricsMiddleware())
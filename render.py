@@ -0,0 +1,206 @@
+# render.py
+import functools
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "5000"))
+
+NESTED_PARENTS = ["Квадрицепсы", "Бицепс бедра"]
+
+
+class SequenceIndex:
+    """Lookup tables derived once from a muscle sequence."""
+
+    def __init__(self, muscle_seq: list):
+        self.muscle_seq = muscle_seq
+        self.subgroup_to_group: Dict[str, str] = {}
+        self.nested_subgroups: Dict[str, List[str]] = {parent: [] for parent in NESTED_PARENTS}
+        for group, subgroup, count in muscle_seq:
+            if isinstance(count, list):
+                for sub_subgroup, _ in count:
+                    self.subgroup_to_group[sub_subgroup] = group
+                    self.nested_subgroups.setdefault(subgroup, []).append(sub_subgroup)
+            else:
+                self.subgroup_to_group[subgroup] = group
+        for parent in self.nested_subgroups:
+            self.nested_subgroups[parent].sort()
+        self.nested_all = frozenset(sub for subs in self.nested_subgroups.values() for sub in subs)
+
+
+@functools.lru_cache(maxsize=None)
+def day_layouts() -> Tuple[SequenceIndex, Dict[str, list]]:
+    """FullBody index and program type -> [(day_num, day_name, program key, index)].
+
+    Built on the first render so importing this module doesn't import the handler modules.
+    """
+    from handlers.prog_fullbody2 import muscle_sequence as fullbody_sequence
+    from handlers.prog_hybrid3 import muscle_sequence_day1, muscle_sequence_day2, muscle_sequence_day3
+    from handlers.prog_upperlower2 import muscle_sequence_day1 as ul_day1, muscle_sequence_day2 as ul_day2, muscle_sequence_day3 as ul_day3, muscle_sequence_day4 as ul_day4
+    from handlers.prog_ap2 import muscle_sequence_day1 as ap_day1, muscle_sequence_day2 as ap_day2
+
+    hybrid3 = [SequenceIndex(seq) for seq in (muscle_sequence_day1, muscle_sequence_day2, muscle_sequence_day3)]
+    upperlower = [SequenceIndex(seq) for seq in (ul_day1, ul_day2, ul_day3, ul_day4)]
+    ap = [SequenceIndex(seq) for seq in (ap_day1, ap_day2)]
+    layouts = {
+        "3 day гибрид верх/низа и фулбади": [
+            (1, "Фулбади", "day1", hybrid3[0]),
+            (2, "Верх", "day2", hybrid3[1]),
+            (3, "Низ", "day3", hybrid3[2]),
+        ],
+        "4 day верх/низ": [
+            (1, "Верх", "day1", upperlower[0]),
+            (2, "Низ", "day2", upperlower[1]),
+            (3, "Верх", "day3", upperlower[2]),
+            (4, "Низ", "day4", upperlower[3]),
+        ],
+        "4 day перед/зад": [
+            (1, "Перед", "day1", ap[0]),
+            (2, "Зад", "day2", ap[1]),
+            (3, "Перед", "day3", ap[0]),
+            (4, "Зад", "day4", ap[1]),
+        ],
+    }
+    return SequenceIndex(fullbody_sequence), layouts
+
+
+@functools.lru_cache(maxsize=None)
+def sequences_digest() -> str:
+    """Hash of every muscle sequence and day layout, so stored renders go stale when handlers/* change."""
+    fullbody, layouts = day_layouts()
+    data = [fullbody.muscle_seq, {
+        program_type: [(day_num, day_name, key, index.muscle_seq) for day_num, day_name, key, index in days]
+        for program_type, days in layouts.items()
+    }]
+    encoded = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=8).hexdigest()
+
+
+FULLBODY_TYPES = ["FullBody 2.0", "FullBody 3.0"]
+
+FOOTER_TEXT = (
+    "\n💡 Техника: <a href='https://t.me/+IkIXHNQL3vgyYzQ8'>ТуторыЗамены</a>\n"
+    "📋 Просмотр: /programma\n"
+    "🔥 Удачи!"
+)
+
+
+def intro_text(program_type: str, days) -> str:
+    return (
+        "😲 Отличный выбор упражнений, спортсмен, очень оптимальный выбор!\n\n"
+        "📝 <i>Упражнения не написаны по исполнительному порядку, начинай тренировку с мышцы, "
+        "которую ты хочешь акцентировать сегодня, и после переходи на следующие упражнения по своему выбору.</i>\n"
+        "💡 <i>Если ты хочешь постепенно добавлять объем, добавляй! Но только если твое тело это позволяет, не нагружай себя просто так.</i>\n\n"
+        f"🏋️ <b>Ваша программа тренировок</b>\n"
+        f"📅 Тип: {program_type}\n"
+        f"🗓 Дней: {days}\n"
+    )
+
+
+def format_day(day_num: int, day_name: str, exercises: list, index: SequenceIndex, sets_reps: str, is_multi_day: bool = True) -> str:
+    muscle_groups: Dict[str, Dict[str, List[str]]] = {}
+    for exercise in exercises:
+        try:
+            subgroup, exercise_name = exercise.split(": ", 1)
+            muscle_group = index.subgroup_to_group.get(subgroup, "Прочее")
+        except ValueError:
+            logger.warning(f"Invalid exercise format: {exercise}")
+            muscle_group, subgroup, exercise_name = "Прочее", "Неизвестная группа", exercise
+        muscle_groups.setdefault(muscle_group, {}).setdefault(subgroup, []).append(exercise_name)
+
+    parts = [f"{day_num}️⃣ <b>День {day_num} ({day_name})</b>\n" if is_multi_day else ""]
+    for muscle_group, subgroups in muscle_groups.items():
+        parts.append(f"\n💪 <b>{muscle_group}</b>\n")
+        if muscle_group == "Ноги" and is_multi_day:
+            for parent_subgroup in NESTED_PARENTS:
+                nested = [sub for sub in index.nested_subgroups[parent_subgroup] if sub in subgroups]
+                if not nested:
+                    continue
+                parts.append(f"  ➡️ <b><i>{parent_subgroup}</i></b>\n")
+                for subgroup in nested:
+                    parts.append(f"    ➡️ <b><i>{subgroup}</i></b>\n")
+                    parts.extend(f"      • {exercise} ({sets_reps})\n" for exercise in subgroups[subgroup])
+            flat_subgroups = sorted(sub for sub in subgroups if sub not in index.nested_all)
+        else:
+            flat_subgroups = sorted(subgroups)
+        for subgroup in flat_subgroups:
+            parts.append(f"  ➡️ <b><i>{subgroup}</i></b>\n")
+            parts.extend(f"    • {exercise} ({sets_reps})\n" for exercise in subgroups[subgroup])
+    day_text = "".join(parts)
+    logger.debug("Formatted day %s (%s) text length: %d", day_num, day_name, len(day_text))
+    return day_text
+
+
+def _render(program: dict) -> Optional[List[str]]:
+    days = program.get('days', 2)
+    sets_reps = program.get('sets_reps', '3 подхода, 3-8 повторений')
+    program_type = program.get('type', 'Unknown')
+    exercises = program["program"]
+    intro = intro_text(program_type, days)
+    fullbody_index, layouts = day_layouts()
+
+    # FullBody programs (list-based) fit in one message
+    if isinstance(exercises, list) and program_type in FULLBODY_TYPES:
+        response = intro + "ℹ️ <i>Программа одинакова для всех дней тренировок.</i>\n\n<b>Упражнения:</b>\n"
+        response += format_day(1, "", exercises, fullbody_index, sets_reps, is_multi_day=False)
+        return [response + FOOTER_TEXT]
+
+    # Multi-day programs (dict-based) send one message per day
+    if isinstance(exercises, dict):
+        layout = layouts.get(program_type)
+        if layout is None:
+            logger.warning(f"Unknown dict-based program type: {program_type}")
+            return None
+        messages = []
+        for day_num, day_name, day_key, index in layout:
+            messages.append(format_day(day_num, day_name, exercises[day_key], index, sets_reps))
+        messages[0] = intro + "\n" + messages[0]
+        messages[-1] += FOOTER_TEXT
+        return messages
+
+    return None
+
+
+def program_hash(program: dict) -> str:
+    data = json.dumps(program, ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class RenderCache:
+    """LRU of rendered messages keyed by the program's content hash, so a
+    changed program (or sets_reps) misses and old entries age out."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[str, Optional[List[str]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, program: dict) -> Optional[List[str]]:
+        key = program_hash(program)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        self.misses += 1
+        messages = _render(program)
+        self._entries[key] = messages
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return messages
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+
+def render_program(program: dict) -> Optional[List[str]]:
+    """Return the message texts for a stored program, or None if its structure is unknown."""
+    return render_cache.get_or_render(program)
@@ -0,0 +1,146 @@
+# sender.py
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows ~30 messages/s overall and ~1 message/s in one chat
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+SEND_CHAT_BUCKETS = int(os.getenv("SEND_CHAT_BUCKETS", "50000"))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _take(self) -> float:
+        """Take a token if available; otherwise return seconds until one is."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while (delay := self._take()) > 0:
+            await asyncio.sleep(delay)
+
+
+class OutboundScheduler:
+    """Paces outgoing API calls with a global and a per-chat token bucket.
+
+    Each chat has its own FIFO drained by a single task, so messages to one
+    chat keep their order while different chats are sent concurrently.
+    """
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 chat_burst: float = SEND_CHAT_BURST, max_retries: int = SEND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._queues: Dict[int, Deque] = {}
+        self._drainers: Dict[int, asyncio.Task] = {}
+        self._latencies: Deque[float] = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            while len(self._chat_buckets) > SEND_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def send(self, chat_id: int, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Queue ``call`` for ``chat_id`` and wait for its result."""
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(chat_id, deque()).append((call, future, time.monotonic()))
+        if chat_id not in self._drainers:
+            self._drainers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return await future
+
+    def send_message(self, bot, chat_id: int, text: str, **kwargs) -> Awaitable[Any]:
+        return self.send(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs))
+
+    async def _drain(self, chat_id: int):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                call, future, enqueued_at = queue.popleft()
+                if future.cancelled():
+                    continue
+                await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+                try:
+                    result = await self._call_with_retry(chat_id, call)
+                except Exception as e:
+                    self.failed += 1
+                    if not future.cancelled():
+                        future.set_exception(e)
+                    continue
+                self.sent += 1
+                self._latencies.append(time.monotonic() - enqueued_at)
+                if not future.cancelled():
+                    future.set_result(result)
+        finally:
+            del self._queues[chat_id]
+            del self._drainers[chat_id]
+
+    async def _call_with_retry(self, chat_id: int, call: Callable[[], Awaitable[Any]]) -> Any:
+        attempt = 0
+        while True:
+            try:
+                return await call()
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.retries += 1
+                delay = e.retry_after * attempt
+                logger.warning(f"Flood limit for chat {chat_id}, retry {attempt} in {delay}s")
+                await asyncio.sleep(delay)
+
+    async def drain(self, timeout: Optional[float] = None):
+        """Wait until every queued message has been sent."""
+        tasks = list(self._drainers.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            "queue_depth": self.queue_depth(),
+            "active_chats": len(self._drainers),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
+
+
+outbound = OutboundScheduler()
@@ -0,0 +1,322 @@
+# sharding.py
+"""Multi-process mode: a front process receives updates (polling or webhook)
+and routes each one to one of N worker processes by hashing its user id.
+Every worker runs the normal dispatcher over its own shard of the program
+database, FSM state and media cache.
+
+Run with ``python sharding.py --workers 4``.
+"""
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
+SHARD_STATS_INTERVAL = float(os.getenv("SHARD_STATS_INTERVAL", "30"))
+SHARD_MAX_CONCURRENT = int(os.getenv("SHARD_MAX_CONCURRENT", "100"))
+# Long-poll timeout of getUpdates in the front process
+POLLING_TIMEOUT = 30
+
+# Update types the handlers in main.py subscribe to
+ALLOWED_UPDATES = ["message", "callback_query", "pre_checkout_query"]
+
+
+def shard_for(user_id, shard_count: int = SHARD_COUNT) -> int:
+    """Stable shard index for a user id (crc32, unlike hash(), is the same in every process)."""
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+
+def owns_user(user_id) -> bool:
+    """Whether this process's shard owns ``user_id`` (always true when not sharded)."""
+    return SHARD_COUNT <= 1 or shard_for(user_id, SHARD_COUNT) == SHARD_INDEX
+
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+        chat = event.get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+
+def shard_db_path(base: str, index: int) -> str:
+    root, ext = os.path.splitext(base)
+    return f"{root}.shard{index}{ext}"
+
+
+def check_shard_layout(workers: int, base: Optional[str] = None):
+    """Refuse to start with a worker count other than the one the shard databases were split for."""
+    base = base or os.getenv("STORAGE_DB", "user_program.db")
+    path = shard_db_path(base, 0)
+    if not os.path.exists(path):
+        return
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'shard_count'").fetchone()
+        except sqlite3.OperationalError:
+            return
+    if row is not None and int(row[0]) != workers:
+        raise SystemExit(f"{path} and its siblings were created for {row[0]} workers, got --workers {workers}. "
+                         f"Start with --workers {row[0]}, or move the shard databases away to re-seed them "
+                         f"from {base} (changes made in sharded mode would be lost).")
+
+
+def _worker(index: int, count: int, inbox: multiprocessing.Queue, stats: multiprocessing.Queue):
+    # The front process handles signals and stops workers through the inbox
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Must be set before storage is imported so the worker opens its own shard
+    os.environ["SHARD_INDEX"] = str(index)
+    os.environ["SHARD_COUNT"] = str(count)
+    base = os.getenv("STORAGE_DB", "user_program.db")
+    os.environ["STORAGE_DB"] = shard_db_path(base, index)
+    # A new shard copies its users from the unsharded database
+    os.environ["STORAGE_SEED_DB"] = base
+    # Each worker gets its share of Telegram's global send limit
+    os.environ["SEND_GLOBAL_RATE"] = str(float(os.getenv("SEND_GLOBAL_RATE", "30")) / count)
+    asyncio.run(_worker_loop(index, inbox, stats))
+
+
+async def _worker_loop(index: int, inbox: multiprocessing.Queue, stats: multiprocessing.Queue):
+    import main
+    from loader import bot, close_bot
+    from storage import user_program, write_behind
+    from render import render_cache
+    from sender import outbound
+
+    main.setup_dispatcher()
+    await write_behind.start()
+    await main.dp.emit_startup(bot=bot, dispatcher=main.dp, bots=[bot])
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(SHARD_MAX_CONCURRENT)
+    tasks = set()
+    handled = 0
+    last_report = 0.0
+
+    async def process(raw):
+        nonlocal handled
+        try:
+            await main.dp.feed_raw_update(bot, raw)
+        except Exception as e:
+            logger.error(f"Shard {index}: error handling update {raw.get('update_id')}: {e}")
+        finally:
+            handled += 1
+            semaphore.release()
+
+    def report():
+        stats.put({
+            "shard": index,
+            "pid": os.getpid(),
+            "handled": handled,
+            "in_flight": len(tasks),
+            "storage": write_behind.stats(),
+            "memory": user_program.memory_stats(),
+            "render_cache": render_cache.stats(),
+            "outbound": outbound.stats(),
+        })
+
+    while True:
+        try:
+            raw = await loop.run_in_executor(None, inbox.get, True, 1.0)
+        except queue.Empty:
+            raw = ...
+        if raw is None:
+            break
+        if raw is not ...:
+            await semaphore.acquire()
+            task = asyncio.create_task(process(raw))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if time.monotonic() - last_report > SHARD_STATS_INTERVAL:
+            last_report = time.monotonic()
+            report()
+
+    if tasks:
+        await asyncio.wait(set(tasks))
+    await outbound.drain(timeout=10)
+    await main.dp.emit_shutdown(bot=bot, dispatcher=main.dp, bots=[bot])
+    await write_behind.stop()
+    await close_bot()
+    report()
+
+
+class ShardRouter:
+    """Owns the worker processes and routes raw updates to them."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        context = multiprocessing.get_context("spawn")
+        self.stats_queue = context.Queue()
+        self.inboxes: List[multiprocessing.Queue] = [context.Queue() for _ in range(workers)]
+        self.processes = [
+            context.Process(target=_worker, args=(i, workers, self.inboxes[i], self.stats_queue), name=f"shard-{i}")
+            for i in range(workers)
+        ]
+        self.routed = [0] * workers
+        self.shard_stats: Dict[int, dict] = {}
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        logger.info(f"Started {self.workers} shard workers")
+
+    def route(self, raw: Dict[str, Any]):
+        user_id = update_user_id(raw)
+        index = shard_for(user_id if user_id is not None else raw["update_id"], self.workers)
+        process = self.processes[index]
+        if not process.is_alive():
+            # Its users' updates would pile up unhandled; the front shuts down instead
+            raise RuntimeError(f"{process.name} exited with code {process.exitcode}")
+        self.routed[index] += 1
+        self.inboxes[index].put(raw)
+
+    def dead_workers(self) -> List[str]:
+        return [f"{p.name} (exit code {p.exitcode})" for p in self.processes if not p.is_alive()]
+
+    def collect_stats(self) -> Dict[int, dict]:
+        while True:
+            try:
+                report = self.stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            report["routed"] = self.routed[report["shard"]]
+            self.shard_stats[report["shard"]] = report
+        return self.shard_stats
+
+    def stop(self, timeout: float = 30):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in {timeout}s, terminating")
+                process.terminate()
+        self.collect_stats()
+        logger.info(f"Shard workers stopped: {self.shard_stats}")
+
+
+async def _poll(router: ShardRouter, stop_event: asyncio.Event):
+    from loader import bot
+
+    offset = None
+    try:
+        while not stop_event.is_set():
+            try:
+                # The request must outlive the long poll, as in aiogram's own polling
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=ALLOWED_UPDATES,
+                                                request_timeout=int(bot.session.timeout + POLLING_TIMEOUT))
+            except Exception as e:
+                logger.error(f"Polling error: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                try:
+                    router.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                except RuntimeError as e:
+                    # Not confirmed, so Telegram delivers it again after a restart
+                    logger.error(f"Cannot route update {update.update_id}: {e}")
+                    stop_event.set()
+                    return
+                offset = update.update_id + 1
+    finally:
+        if offset is not None:
+            # Confirm the last routed batch so it isn't delivered again after a restart
+            try:
+                await bot.get_updates(offset=offset, timeout=0, limit=1, allowed_updates=ALLOWED_UPDATES)
+            except Exception as e:
+                logger.warning(f"Could not confirm updates before {offset}: {e}")
+
+
+async def _serve_webhook(router: ShardRouter, stop_event: asyncio.Event):
+    from aiohttp import web
+    from loader import bot
+    from webhook import SECRET_HEADER, WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL
+
+    async def handle(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        try:
+            router.route(await request.json())
+        except RuntimeError as e:
+            # Telegram retries it; the worker watch stops the front
+            logger.error(f"Cannot route update: {e}")
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None,
+                          allowed_updates=ALLOWED_UPDATES)
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_front(workers: int, mode: str = "polling"):
+    from loader import close_bot
+
+    check_shard_layout(workers)
+    router = ShardRouter(workers)
+    router.start()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async def log_stats():
+        while not stop_event.is_set():
+            await asyncio.sleep(SHARD_STATS_INTERVAL)
+            for index, report in sorted(router.collect_stats().items()):
+                logger.info(f"Shard {index}: routed={report['routed']} handled={report['handled']} "
+                            f"in_flight={report['in_flight']} pending_dirty={report['storage']['pending_dirty']}")
+
+    failed = []
+
+    async def watch_workers():
+        while not stop_event.is_set():
+            await asyncio.sleep(1)
+            failed.extend(router.dead_workers())
+            if failed:
+                logger.error(f"Shard worker died: {', '.join(failed)}; stopping")
+                stop_event.set()
+
+    receiver = _serve_webhook(router, stop_event) if mode == "webhook" else _poll(router, stop_event)
+    tasks = [asyncio.create_task(receiver), asyncio.create_task(log_stats()), asyncio.create_task(watch_workers())]
+    await stop_event.wait()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    failed = failed or router.dead_workers()
+    await close_bot()
+    await loop.run_in_executor(None, router.stop)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run the bot as N user-sharded worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=os.getenv("BOT_MODE", "polling"))
+    args = parser.parse_args()
+    asyncio.run(run_front(args.workers, args.mode))
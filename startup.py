@@ -0,0 +1,32 @@
+# startup.py
+"""Startup timeline: seconds from the start of imports to each startup phase.
+
+Imported first by main.py; the report is logged once the first update has
+been handled.
+"""
+import logging
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+STARTED_AT = time.perf_counter()
+
+phases: Dict[str, float] = {}
+
+
+def mark(phase: str):
+    """Record when ``phase`` was reached; only the first mark counts."""
+    if phase not in phases:
+        phases[phase] = time.perf_counter() - STARTED_AT
+
+
+def first_update_handled():
+    if "first_update" in phases:
+        return
+    mark("first_update")
+    logger.info("Startup timing: %s", ", ".join(f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in phases.items()))
+
+
+def stats() -> Dict[str, float]:
+    return dict(phases)
@@ -1,39 +1,774 @@
 # storage.py
+import hashlib
 import json
 import os
 import logging
-from typing import Dict, List
+import sqlite3
+import sys
+import threading
+import time
+import asyncio
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+from sharding import SHARD_COUNT, owns_user
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Legacy whole-file storage, imported into the database once on first start
 STORAGE_FILE = "user_program.json"
+STORAGE_DB = os.getenv("STORAGE_DB", "user_program.db")
+# Unsharded database a shard worker copies its users from on first start (set by sharding.py)
+STORAGE_SEED_DB = os.getenv("STORAGE_SEED_DB")
+
+# How long a read record stays decoded in memory; in-place edits not picked up
+# by a save are found when it expires (see ``_sweep``)
+TOUCH_GRACE_SECONDS = 60.0
+# Compact rows of idle users kept in memory (others are re-read from disk)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+# Most recently saved users preloaded into that cache in the background after start
+USER_WARMUP = int(os.getenv("USER_WARMUP", "10000"))
+
+# Write-behind: flush dirty users every N seconds or once this many are pending
+FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "1.0"))
+FLUSH_THRESHOLD = int(os.getenv("STORAGE_FLUSH_THRESHOLD", "100"))
+
+
+class UserProgramStore(MutableMapping):
+    """Dict-like user_program backed by SQLite in WAL mode.
+
+    Records are loaded on first access and a save writes only the users that
+    were read or assigned since the previous save and whose record actually
+    changed, so its cost follows the traffic between saves, not the number
+    of active users.
+    Saving is split into ``collect`` (event loop), ``write`` (any thread,
+    disk only) and ``commit`` (event loop) so it can run write-behind.
+
+    Rows are stored compactly: every string (exercise, type, sets_reps) is
+    interned once in the ``strings`` catalog and records hold arrays of its
+    ids. Only recently touched users are kept decoded in memory; others stay
+    as compact rows in a bounded LRU or on disk.
+
+    With a renderer set (see ``set_renderer``) every saved record also gets
+    its rendered form written to the ``rendered`` table in the same batch.
+
+    A new shard database is seeded from ``seed_db`` with the users its shard
+    owns. With ``shard_count`` given the database records it and refuses to
+    open for a different count, since users would then belong to other shards.
+    """
+
+    def __init__(self, path: str, legacy_file: Optional[str] = None, cold_size: int = USER_CACHE_SIZE,
+                 seed_db: Optional[str] = None, shard_count: Optional[int] = None):
+        self.path = path
+        self.cold_size = cold_size
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        # WAL lets the reader connection proceed while the writer commits
+        self._writer = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        # Shard workers seeding at the same time all write to the unsharded database's meta
+        self._writer.execute("PRAGMA busy_timeout=5000")
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS user_program (user_id TEXT PRIMARY KEY, record TEXT NOT NULL)"
+        )
+        self._writer.execute("CREATE TABLE IF NOT EXISTS strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)")
+        self._writer.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._writer.execute(
+            "CREATE TABLE IF NOT EXISTS rendered (user_id TEXT PRIMARY KEY, digest TEXT NOT NULL, value TEXT NOT NULL)"
+        )
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        self._new_strings: List[tuple] = []
+        for string_id, value in self._conn.execute("SELECT id, value FROM strings ORDER BY id"):
+            self._add_string(value, string_id)
+        # Decoded records of recently touched or unsaved users
+        self._hot: Dict[str, Any] = {}
+        # Compact row last loaded/written for each hot user, for change detection
+        self._persisted: Dict[str, str] = {}
+        # Compact rows of users read earlier, kept instead of decoded dicts
+        self._cold: OrderedDict[str, str] = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        # Users read or assigned since the last ``collect``
+        self._recent: set = set()
+        # Users assigned or explicitly marked since the last ``collect``; only these count
+        # toward the write-behind threshold, read-only users wait for the interval
+        self._assigned: set = set()
+        self._dirty: set = set()
+        self._deleted: set = set()
+        # Users whose upsert is in a batch between ``collect`` and ``commit``/``restore``
+        self._writing: set = set()
+        self._last_sweep = time.monotonic()
+        self._renderer: Optional[Callable[[Any], Optional[str]]] = None
+        self._render_version = ""
+        # Saved users whose rendered row is missing or outdated, filled on the next save
+        self._render_missing: set = set()
+        if shard_count is not None:
+            self._check_shard_count(shard_count)
+        if seed_db and os.path.exists(seed_db):
+            self._seed_from(seed_db, shard_count or 1)
+        if legacy_file:
+            self._import_legacy(legacy_file)
+
+    # string catalog
+
+    def _add_string(self, value: str, string_id: int):
+        value = sys.intern(value)
+        while len(self._strings) <= string_id:
+            self._strings.append("")
+        self._strings[string_id] = value
+        self._string_ids[value] = string_id
+
+    def _intern(self, value: str) -> int:
+        string_id = self._string_ids.get(value)
+        if string_id is None:
+            string_id = max(len(self._strings), 1)
+            self._add_string(value, string_id)
+            self._new_strings.append((string_id, value))
+        return string_id
+
+    def _intern_list(self, values) -> Optional[List[int]]:
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            return None
+        return [self._intern(v) for v in values]
+
+    def encode(self, record: Any) -> str:
+        """Compact row: [days, type id, sets_reps id, program ids, other fields]."""
+        if not isinstance(record, dict):
+            return json.dumps(record, ensure_ascii=False)
+        extra = {k: v for k, v in record.items() if k not in ("days", "type", "sets_reps", "program")}
+        days = record.get("days")
+        if days is not None and not isinstance(days, int):
+            extra["days"], days = days, None
+        type_id = sets_id = program = None
+        if isinstance(record.get("type"), str):
+            type_id = self._intern(record["type"])
+        elif "type" in record:
+            extra["type"] = record["type"]
+        if isinstance(record.get("sets_reps"), str):
+            sets_id = self._intern(record["sets_reps"])
+        elif "sets_reps" in record:
+            extra["sets_reps"] = record["sets_reps"]
+        if "program" in record:
+            value = record["program"]
+            if isinstance(value, dict):
+                program = {day: self._intern_list(items) for day, items in value.items()}
+                if any(ids is None for ids in program.values()):
+                    program = None
+            else:
+                program = self._intern_list(value)
+            if program is None:
+                extra["program"] = value
+        return json.dumps([days, type_id, sets_id, program, extra or None], ensure_ascii=False, separators=(",", ":"))
+
+    def decode(self, row: str) -> Any:
+        data = json.loads(row)
+        if not isinstance(data, list):
+            return data  # plain JSON written before the compact format
+        days, type_id, sets_id, program, extra = data
+        strings = self._strings
+        record: Dict[str, Any] = {}
+        if days is not None:
+            record["days"] = days
+        if isinstance(program, dict):
+            record["program"] = {day: [strings[i] for i in ids] for day, ids in program.items()}
+        elif program is not None:
+            record["program"] = [strings[i] for i in program]
+        if type_id is not None:
+            record["type"] = strings[type_id]
+        if sets_id is not None:
+            record["sets_reps"] = strings[sets_id]
+        if extra:
+            record.update(extra)
+        return record
+
+    def set_renderer(self, renderer: Callable[[Any], Optional[str]],
+                     version: Union[str, Callable[[], str]] = ""):
+        """Store ``renderer(record)`` next to each saved record; ``version`` must change with its output.
+
+        A callable ``version`` is resolved on first use, so it may depend on modules imported later.
+        """
+        self._renderer = renderer
+        self._render_version = version
+
+    def _digest(self, row: str) -> str:
+        if callable(self._render_version):
+            self._render_version = self._render_version()
+        data = (self._render_version + "\0" + row).encode("utf-8")
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def rendered(self, user_id) -> Optional[str]:
+        """Rendered value saved with the user's current record, or None if missing or stale."""
+        user_id = str(user_id)
+        row = self._persisted.get(user_id)
+        if self._renderer is None or row is None or user_id in self._dirty:
+            return None
+        record = self._hot.get(user_id)
+        if record is not None and self.encode(record) != row:
+            return None  # changed in place and not saved yet
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT value FROM rendered WHERE user_id = ? AND digest = ?", (user_id, self._digest(row))
+            ).fetchone()
+        if found is None:
+            self._render_missing.add(user_id)
+            return None
+        return found[0]
+
+    def _import_legacy(self, legacy_file: str):
+        if self._get_meta("legacy_imported") or not os.path.exists(legacy_file):
+            return
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse {legacy_file}: {e}. Skipping import, will retry on next start.")
+            return
+        except Exception as e:
+            logger.error(f"Error loading {legacy_file}: {e}. Skipping import, will retry on next start.")
+            return
+        # In sharded mode each worker imports only the users its shard owns
+        rows = [(str(k), self.encode(v)) for k, v in data.items() if owns_user(k)]
+        with self._write_lock:
+            self._writer.execute("BEGIN")
+            try:
+                self._writer.executemany("INSERT INTO strings VALUES (?, ?)", self._new_strings)
+                self._writer.executemany("INSERT OR IGNORE INTO user_program VALUES (?, ?)", rows)
+                self._writer.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_imported', '1')")
+                self._writer.execute("COMMIT")
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+        self._new_strings = []
+        logger.info(f"Imported {len(rows)} users from {legacy_file} into {self.path}")
+
+    def _check_shard_count(self, shard_count: int):
+        recorded = self._get_meta("shard_count")
+        if recorded is None:
+            self._set_meta("shard_count", str(shard_count))
+        elif int(recorded) != shard_count:
+            raise RuntimeError(
+                f"{self.path} belongs to a {recorded}-shard layout but {shard_count} shard(s) are configured; "
+                f"start with --workers {recorded}" + (" or move the shard databases away to reshard" if shard_count > 1 else "")
+            )
+        elif shard_count == 1 and self._get_meta("sharded_into"):
+            logger.warning(f"{self.path} was split into {self._get_meta('sharded_into')} shards; "
+                           f"changes made in sharded mode are not in it")
+
+    def _seed_from(self, seed_db: str, shard_count: int):
+        """Copy the users this shard owns from the unsharded database, once per new shard."""
+        if self._get_meta("seeded"):
+            return
+        with self._write_lock:
+            has_users = self._writer.execute("SELECT 1 FROM user_program LIMIT 1").fetchone() is not None
+        if has_users:
+            # Created before seeding existed; its rows are newer than the unsharded copy
+            self._set_meta("seeded", "existing")
+            return
+        source = UserProgramStore(seed_db)
+        try:
+            # Re-encode through this database's string catalog, the ids differ per file
+            rows = [(user_id, self.encode(record)) for user_id, record in source.iter_records() if owns_user(user_id)]
+            source._set_meta("sharded_into", str(shard_count))
+        finally:
+            source.close()
+        with self._write_lock:
+            self._writer.execute("BEGIN")
+            try:
+                self._writer.executemany("INSERT INTO strings VALUES (?, ?)", self._new_strings)
+                self._writer.executemany("INSERT OR IGNORE INTO user_program VALUES (?, ?)", rows)
+                self._writer.execute("INSERT OR REPLACE INTO meta VALUES ('seeded', ?)", (seed_db,))
+                # The unsharded database already holds the legacy file's users
+                self._writer.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_imported', '1')")
+                self._writer.execute("COMMIT")
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+        self._new_strings = []
+        logger.info(f"Seeded {len(rows)} users from {seed_db} into {self.path}")
+
+    def _set_meta(self, key: str, value: str):
+        with self._write_lock:
+            self._writer.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        with self._write_lock:
+            row = self._writer.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _fetch_row(self, user_id: str) -> Optional[str]:
+        if user_id in self._deleted:
+            return None
+        row = self._cold.pop(user_id, None)
+        if row is not None:
+            return row
+        with self._lock:
+            found = self._conn.execute(
+                "SELECT record FROM user_program WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return found[0] if found else None
+
+    def _load(self, user_id: str) -> bool:
+        row = self._fetch_row(user_id)
+        if row is None:
+            return False
+        self._hot[user_id] = self.decode(row)
+        self._persisted[user_id] = row
+        return True
+
+    def _cool(self, user_id: str):
+        """Drop a clean user's decoded record, keeping only its compact row."""
+        self._hot.pop(user_id, None)
+        row = self._persisted.pop(user_id, None)
+        if row is None:
+            return
+        self._cold[user_id] = row
+        if len(self._cold) > self.cold_size:
+            self._cold.popitem(last=False)
+
+    def __getitem__(self, user_id) -> Any:
+        user_id = str(user_id)
+        if user_id not in self._hot and (user_id in self._deleted or not self._load(user_id)):
+            raise KeyError(user_id)
+        now = time.monotonic()
+        self._touched[user_id] = now
+        self._recent.add(user_id)
+        if now - self._last_sweep > TOUCH_GRACE_SECONDS:
+            self._sweep(now)
+        return self._hot[user_id]
+
+    def __setitem__(self, user_id, record: Any):
+        user_id = str(user_id)
+        self._cold.pop(user_id, None)
+        self._hot[user_id] = record
+        self._touched[user_id] = time.monotonic()
+        self._recent.add(user_id)
+        self._assigned.add(user_id)
+        self._dirty.add(user_id)
+        self._deleted.discard(user_id)
+
+    def __delitem__(self, user_id):
+        user_id = str(user_id)
+        if user_id not in self:
+            raise KeyError(user_id)
+        self._hot.pop(user_id, None)
+        self._cold.pop(user_id, None)
+        self._touched.pop(user_id, None)
+        self._recent.discard(user_id)
+        self._assigned.discard(user_id)
+        self._dirty.discard(user_id)
+        # An upsert still on the writer thread would otherwise recreate the row
+        if (self._persisted.pop(user_id, None) is not None or user_id in self._writing
+                or self._row_exists(user_id)):
+            self._deleted.add(user_id)
+
+    def _row_exists(self, user_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM user_program WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row is not None
+
+    def __contains__(self, user_id) -> bool:
+        user_id = str(user_id)
+        if user_id in self._hot:
+            return True
+        if user_id in self._deleted:
+            return False
+        return user_id in self._cold or self._row_exists(user_id)
+
+    def __iter__(self) -> Iterator[str]:
+        # Keyset pagination keeps iteration streaming and safe against concurrent saves
+        unsaved = [k for k in self._hot if k not in self._persisted]
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT user_id FROM user_program WHERE user_id > ? ORDER BY user_id LIMIT 500",
+                    (last,),
+                ).fetchall()
+            if not rows:
+                break
+            for (user_id,) in rows:
+                if user_id not in self._deleted:
+                    yield user_id
+            last = rows[-1][0]
+        yield from unsaved
+
+    async def warm_up(self, limit: int = USER_WARMUP, batch_size: int = 1000) -> int:
+        """Preload compact rows of the most recently saved users into the idle cache.
+
+        Rows are read on a worker thread in batches, so startup doesn't wait
+        for it and the event loop is never blocked on the whole table.
+        """
+        limit = min(limit, self.cold_size)
+        loop = asyncio.get_running_loop()
+        loaded = 0
+        before = None
+        while loaded < limit:
+            rows = await loop.run_in_executor(None, self._recent_rows, before, min(batch_size, limit - loaded))
+            if not rows:
+                break
+            for rowid, user_id, row in rows:
+                if user_id not in self._hot and user_id not in self._cold and user_id not in self._deleted:
+                    # Oldest first, so the warm rows don't push out users read since start
+                    self._cold[user_id] = row
+                    self._cold.move_to_end(user_id, last=False)
+            while len(self._cold) > self.cold_size:
+                self._cold.popitem(last=False)
+            loaded += len(rows)
+            before = rows[-1][0]
+        logger.info("Warmed up %d users from %s", loaded, self.path)
+        return loaded
+
+    def _recent_rows(self, before: Optional[int], limit: int) -> list:
+        with self._lock:
+            if before is None:
+                return self._conn.execute(
+                    "SELECT rowid, user_id, record FROM user_program ORDER BY rowid DESC LIMIT ?", (limit,)
+                ).fetchall()
+            return self._conn.execute(
+                "SELECT rowid, user_id, record FROM user_program WHERE rowid < ? ORDER BY rowid DESC LIMIT ?",
+                (before, limit),
+            ).fetchall()
+
+    def iter_records(self, batch_size: int = 1000) -> Iterator[tuple]:
+        """Stream ``(user_id, record)`` pairs page by page without caching them.
+
+        Used by offline jobs; only one page of rows is held in memory at a time.
+        """
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT user_id, record FROM user_program WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                    (last, batch_size),
+                ).fetchall()
+            if not rows:
+                break
+            for user_id, row in rows:
+                if user_id in self._deleted:
+                    continue
+                hot = self._hot.get(user_id)
+                yield user_id, hot if hot is not None else self.decode(row)
+            last = rows[-1][0]
+        for user_id, record in list(self._hot.items()):
+            if user_id not in self._persisted:
+                yield user_id, record
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM user_program").fetchone()
+        unsaved = sum(1 for k in self._hot if k not in self._persisted)
+        return count + unsaved - len(self._deleted)
+
+    def mark_dirty(self, user_id=None):
+        """Queue one user (or every user read or assigned since the last save) for the next save."""
+        if user_id is not None:
+            self._dirty.add(str(user_id))
+            self._assigned.add(str(user_id))
+            return
+        self._dirty.update(self._recent)
+
+    def mark_touched(self):
+        """Queue every user touched within the grace period; used before a final save."""
+        self._sweep(time.monotonic())
+        self._dirty.update(self._touched)
+
+    def _sweep(self, now: float):
+        """Forget touches older than the grace period and cool those users.
+
+        A record edited in place after the save that followed its read is
+        caught here: it is compared once more and saved instead of cooled.
+        """
+        self._last_sweep = now
+        for key, touched_at in list(self._touched.items()):
+            if now - touched_at > TOUCH_GRACE_SECONDS:
+                del self._touched[key]
+                if key in self._dirty or key not in self._persisted:
+                    continue
+                try:
+                    changed = self.encode(self._hot[key]) != self._persisted[key]
+                except Exception:
+                    changed = True  # let collect log it
+                if changed:
+                    self._dirty.add(key)
+                else:
+                    self._cool(key)
+
+    def pending(self) -> int:
+        return len(self._dirty) + len(self._deleted) + len(self._render_missing)
+
+    def changed(self) -> int:
+        """Users known to need a write (assigned, marked by id or deleted)."""
+        return len(self._assigned) + len(self._deleted)
+
+    def _render_row(self, key: str, record: Any, row: str) -> Optional[tuple]:
+        value = self._renderer(record)
+        return None if value is None else (key, self._digest(row), value)
+
+    def collect(self):
+        """Encode dirty records that changed; the returned batch is handed to ``write``."""
+        upserts = []
+        rendered = []
+        self._recent.clear()
+        self._assigned.clear()
+        for key in self._dirty:
+            if key not in self._hot:
+                continue
+            try:
+                row = self.encode(self._hot[key])
+            except Exception as e:
+                # Not re-queued: the same record would fail every flush
+                logger.error("Cannot save user %s, record is not serializable: %s", key, e)
+                continue
+            if row != self._persisted.get(key):
+                upserts.append((key, row))
+                if self._renderer is not None:
+                    rendered.append(self._render_row(key, self._hot[key], row))
+                    self._render_missing.discard(key)
+        self._dirty.clear()
+        for key in self._render_missing:
+            if key in self._hot and key in self._persisted:
+                rendered.append(self._render_row(key, self._hot[key], self._persisted[key]))
+        self._render_missing.clear()
+        deletes = [(key,) for key in self._deleted]
+        self._writing.update(key for key, _ in upserts)
+        strings, self._new_strings = self._new_strings, []
+        return upserts, deletes, strings, [r for r in rendered if r is not None]
+
+    def write(self, batch):
+        upserts, deletes, strings, rendered = batch
+        if not upserts and not deletes and not strings and not rendered:
+            return
+        with self._write_lock:
+            self._writer.execute("BEGIN")
+            try:
+                self._writer.executemany("INSERT OR REPLACE INTO strings VALUES (?, ?)", strings)
+                self._writer.executemany("INSERT OR REPLACE INTO user_program VALUES (?, ?)", upserts)
+                self._writer.executemany("DELETE FROM user_program WHERE user_id = ?", deletes)
+                self._writer.executemany("INSERT OR REPLACE INTO rendered VALUES (?, ?, ?)", rendered)
+                self._writer.executemany("DELETE FROM rendered WHERE user_id = ?", deletes)
+                self._writer.execute("COMMIT")
+            except Exception:
+                self._writer.execute("ROLLBACK")
+                raise
+
+    def commit(self, batch) -> int:
+        upserts, deletes, _, _ = batch
+        now = time.monotonic()
+        for key, row in upserts:
+            self._writing.discard(key)
+            if key in self._deleted or key not in self._hot:
+                continue  # deleted while the batch was being written
+            self._persisted[key] = row
+            touched_at = self._touched.get(key)
+            if key not in self._dirty and (touched_at is None or now - touched_at > TOUCH_GRACE_SECONDS):
+                self._touched.pop(key, None)
+                self._cool(key)
+        for (key,) in deletes:
+            if key not in self._hot:
+                self._deleted.discard(key)
+        return len(upserts) + len(deletes)
+
+    def restore(self, batch):
+        """Re-queue a batch whose write failed."""
+        upserts, _, strings, rendered = batch
+        self._writing.difference_update(key for key, _ in upserts)
+        self._dirty.update(key for key, _ in upserts if key in self._hot)
+        self._render_missing.update(row[0] for row in rendered if row[0] in self._hot)
+        self._new_strings = strings + self._new_strings
+
+    def save(self, user_id=None) -> int:
+        """Synchronously write changed records (of every touched user by default); returns rows written."""
+        if user_id is None:
+            self.mark_touched()
+        else:
+            self.mark_dirty(user_id)
+        batch = self.collect()
+        self.write(batch)
+        return self.commit(batch)
+
+    def memory_stats(self) -> Dict[str, int]:
+        return {
+            "hot_users": len(self._hot),
+            "cold_users": len(self._cold),
+            "cold_bytes": sum(len(row) for row in self._cold.values()),
+            "catalog_strings": len(self._string_ids),
+        }
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        with self._lock:
+            self._conn.close()
+
+
+class WriteBehind:
+    """Background task that batches dirty records of the given stores to disk.
+
+    Flushes run on ``interval`` or as soon as ``threshold`` records are
+    pending; disk work happens on a single writer thread so the event loop
+    never blocks on I/O.
+    """
+
+    def __init__(self, stores: List, interval: float = FLUSH_INTERVAL, threshold: int = FLUSH_THRESHOLD):
+        self.stores = list(stores)
+        self.interval = interval
+        self.threshold = threshold
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.flush_count = 0
+        self.records_written = 0
+        self.last_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+        self.total_flush_duration = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def add_store(self, store):
+        self.stores.append(store)
+
+    def pending(self) -> int:
+        return sum(store.pending() for store in self.stores)
+
+    def notify(self):
+        # Only real changes count: a no-argument save also queues users that were just read
+        if self._wake is not None and sum(store.changed() for store in self.stores) >= self.threshold:
+            self._wake.set()
+
+    async def start(self):
+        if self.running:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-writer")
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._closing = False
+        self._task = asyncio.create_task(self._run(), name="storage-write-behind")
+        logger.info(f"Write-behind started: interval={self.interval}s, threshold={self.threshold}")
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # Keep flushing: the next round may succeed and stop() must still run
+                logger.exception("Write-behind flush failed: %s", e)
+
+    async def flush(self) -> int:
+        if self._flush_lock is None:
+            # Not started: write synchronously, as the stores do without write-behind
+            return self._flush_sync()
+        async with self._flush_lock:
+            batches = []
+            for store in self.stores:
+                if not store.pending():
+                    continue
+                try:
+                    batches.append((store, store.collect()))
+                except Exception as e:
+                    logger.exception("Write-behind collect failed for %s: %s", type(store).__name__, e)
+            if not batches:
+                return 0
+            started = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            written = 0
+            for store, batch in batches:
+                try:
+                    await loop.run_in_executor(self._executor, store.write, batch)
+                    written += store.commit(batch)
+                except Exception as e:
+                    logger.error(f"Write-behind flush failed for {type(store).__name__}: {e}")
+                    store.restore(batch)
+            duration = time.perf_counter() - started
+            self.flush_count += 1
+            self.records_written += written
+            self.last_flush_duration = duration
+            self.max_flush_duration = max(self.max_flush_duration, duration)
+            self.total_flush_duration += duration
+            logger.debug("Write-behind flushed %d records in %.1f ms", written, duration * 1000)
+            return written
+
+    def _flush_sync(self) -> int:
+        written = 0
+        for store in self.stores:
+            if not store.pending():
+                continue
+            batch = store.collect()
+            try:
+                store.write(batch)
+            except Exception:
+                store.restore(batch)
+                raise
+            written += store.commit(batch)
+        return written
+
+    async def stop(self):
+        """Stop the background task after its final flush."""
+        if self._task is not None:
+            self._closing = True
+            self._wake.set()
+            try:
+                await self._task
+            except Exception as e:
+                logger.exception("Write-behind task failed: %s", e)
+            self._task = None
+        if self._executor is not None:
+            for store in self.stores:
+                # Edits to records read before the last flush are only found by a full pass
+                mark_touched = getattr(store, "mark_touched", None)
+                if mark_touched is not None:
+                    mark_touched()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("Final write-behind flush failed: %s", e)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        logger.info(f"Write-behind stopped after {self.flush_count} flushes")
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "pending_dirty": self.pending(),
+            "flush_count": self.flush_count,
+            "records_written": self.records_written,
+            "last_flush_seconds": self.last_flush_duration,
+            "max_flush_seconds": self.max_flush_duration,
+            "total_flush_seconds": self.total_flush_duration,
+        }
+
+
+# Initialize user_program mapping
+user_program = UserProgramStore(STORAGE_DB, legacy_file=STORAGE_FILE, seed_db=STORAGE_SEED_DB, shard_count=SHARD_COUNT)
+write_behind = WriteBehind([user_program])
+
+
+def save_user_program(user_id=None):
+    """Save changed user_program records (only ``user_id`` when given).
 
-# Initialize user_program dictionary
-user_program: Dict[str, Dict[str, List[str]]] = {}
-
-# Load data at startup
-try:
-    if os.path.exists(STORAGE_FILE):
-        with open(STORAGE_FILE, "r", encoding="utf-8") as f:
-            user_program = json.load(f)
-            # Ensure keys are strings
-            user_program = {str(k): v for k, v in user_program.items()}
-            logger.info(f"Loaded user_program from {STORAGE_FILE}: {len(user_program)} users")
-    else:
-        logger.warning(f"File {STORAGE_FILE} does not exist. Starting with empty user_program.")
-except json.JSONDecodeError as e:
-    logger.error(f"Failed to parse {STORAGE_FILE}: {e}. Starting with empty user_program.")
-    user_program = {}
-except Exception as e:
-    logger.error(f"Error loading {STORAGE_FILE}: {e}. Starting with empty user_program.")
-    user_program = {}
-
-def save_user_program():
-    """Save user_program to file."""
+    While ``write_behind`` is running this only marks the records dirty;
+    otherwise it writes synchronously.
+    """
     try:
-        with open(STORAGE_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_program, f, ensure_ascii=False, indent=2)
-        logger.info(f"Saved user_program to {STORAGE_FILE}: {len(user_program)} users")
+        if write_behind.running:
+            user_program.mark_dirty(user_id)
+            write_behind.notify()
+            return
+        written = user_program.save(user_id)
+        logger.debug("Saved user_program to %s: %d records written", STORAGE_DB, written)
     except Exception as e:
-        logger.error(f"Error saving {STORAGE_FILE}: {e}")
\ No newline at end of file
+        logger.error(f"Error saving {STORAGE_DB}: {e}")
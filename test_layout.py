@@ -0,0 +1,86 @@
+# test_layout.py
+"""Tests for splitting rendered HTML into Telegram-sized messages (run with
+``python -m unittest test_layout``)."""
+import html
+import random
+import re
+import unittest
+
+from layout import TAG_RE, split_html, utf16_len
+
+WORDS = ["Жим", "лёжа", "Присед", "3x10", "💪", "🔥🔥", "&amp;", "&lt;5&gt;", "A" * 120, "подход"]
+TAGS = [("<b>", "</b>"), ("<i>", "</i>"), ("<a href='https://t.me/x'>", "</a>"), ("<b><i>", "</i></b>")]
+
+
+def random_html(rng: random.Random, words: int) -> str:
+    parts = []
+    for _ in range(words):
+        word = rng.choice(WORDS)
+        if rng.random() < 0.2:
+            opening, closing = rng.choice(TAGS)
+            word = opening + word + " " + rng.choice(WORDS) + closing
+        parts.append(word)
+        parts.append("\n" if rng.random() < 0.15 else " ")
+    return "".join(parts).strip()
+
+
+def visible(text: str) -> str:
+    return html.unescape(re.sub(r"<[^>]*>", "", text))
+
+
+def unbalanced_tags(chunk: str) -> list:
+    stack = []
+    for tag in re.findall(r"<[^>]*>", chunk):
+        closing, name = TAG_RE.match(tag).groups()
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return [tag]
+    return stack
+
+
+class SplitHtmlTest(unittest.TestCase):
+    def check(self, text: str, limit: int):
+        chunks = split_html(text, limit)
+        for chunk in chunks:
+            self.assertLessEqual(utf16_len(visible(chunk)), limit, chunk)
+            self.assertEqual(unbalanced_tags(chunk), [], chunk)
+            self.assertTrue(visible(chunk).strip(), "empty chunk")
+        # Breaks only drop whitespace
+        self.assertEqual(re.sub(r"\s", "", "".join(visible(c) for c in chunks)), re.sub(r"\s", "", visible(text)))
+        return chunks
+
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(split_html("<b>Фулбади</b>\nЖим", 4096), ["<b>Фулбади</b>\nЖим"])
+
+    def test_random_texts(self):
+        rng = random.Random(1)
+        for limit in (50, 200, 4096):
+            for _ in range(30):
+                self.check(random_html(rng, rng.randint(1, 2000)), limit)
+
+    def test_counts_utf16_units(self):
+        # Each emoji is two UTF-16 units: 17 of them and 16 spaces make exactly 50
+        chunks = self.check(" ".join(["💪"] * 30), 50)
+        self.assertEqual([chunk.count("💪") for chunk in chunks], [17, 13])
+
+    def test_entity_counts_as_one_character(self):
+        self.assertEqual(split_html("&amp;" * 50, 50), ["&amp;" * 50])
+
+    def test_tags_reopen_in_next_chunk(self):
+        chunks = self.check("<b>" + " ".join(["слово"] * 30) + "</b>", 50)
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertTrue(chunk.startswith("<b>") and chunk.endswith("</b>"), chunk)
+
+    def test_prefers_line_breaks(self):
+        chunks = self.check("первая строка\n" + "вторая строка " * 3, 40)
+        self.assertEqual(chunks[0], "первая строка")
+
+    def test_long_word_is_cut(self):
+        chunks = self.check("x" * 130, 50)
+        self.assertEqual("".join(chunks), "x" * 130)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+# test_render_state.py
+"""Regression test for the check_subscription render-state cache (run with
+``python -m unittest test_render_state``). Uses the offline Bot API session
+from fake_telegram.py."""
+import os
+import tempfile
+import unittest
+
+os.environ["STORAGE_DB"] = os.path.join(tempfile.mkdtemp(prefix="bot-test-"), "test.db")
+# Every press is handled and every subscription check reaches the (fake) API
+os.environ["SUB_CHECK_DEBOUNCE"] = "0"
+os.environ["CALLBACK_DEDUPE_WINDOW"] = "0"
+os.environ["SUB_CACHE_POSITIVE_TTL"] = "0"
+os.environ["SUB_CACHE_NEGATIVE_TTL"] = "0"
+
+import main  # noqa: E402
+import loader  # noqa: E402
+from fake_telegram import FakeTelegramSession, callback_update  # noqa: E402
+
+USER_ID = 4242
+MESSAGE_ID = 777
+
+
+def press(data: str):
+    update = callback_update(USER_ID, data, caption="...")
+    update["callback_query"]["message"]["message_id"] = MESSAGE_ID
+    return update
+
+
+class CheckSubscriptionEditTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.session = FakeTelegramSession()
+        loader.bot.session = cls.session
+        main.setup_dispatcher()
+
+    async def test_edit_after_another_handler_changed_the_message(self):
+        self.session.member_status = "member"
+        await main.dp.feed_raw_update(loader.bot, press("check_subscription"))
+        self.assertEqual(self.session.calls["EditMessageCaption"], 1)
+
+        # Another handler rewrites the same message to the "not subscribed" text
+        self.session.member_status = "left"
+        await main.dp.feed_raw_update(loader.bot, press("start_programma"))
+        self.assertEqual(self.session.calls["EditMessageCaption"], 2)
+
+        # Subscribed again: the stale cache entry must not suppress the edit
+        self.session.member_status = "member"
+        await main.dp.feed_raw_update(loader.bot, press("check_subscription"))
+        self.assertEqual(self.session.calls["EditMessageCaption"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+# test_storage.py
+"""Regression tests for UserProgramStore and write-behind (run with
+``python -m unittest test_storage``)."""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ["STORAGE_DB"] = os.path.join(tempfile.mkdtemp(prefix="bot-test-"), "test.db")
+
+import sharding  # noqa: E402
+import storage  # noqa: E402
+from storage import UserProgramStore, WriteBehind  # noqa: E402
+
+PROGRAM = {
+    "days": 3,
+    "type": "3 day гибрид верх/низа и фулбади",
+    "sets_reps": "2-3 подхода по 6-10 повторений",
+    "program": {"day1": ["Присед", "Жим лёжа"], "day2": ["Тяга"], "day3": ["Жим ногами"]},
+}
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="bot-test-")
+        self.path = os.path.join(self.dir, "users.db")
+        self.store = self.open()
+
+    def tearDown(self):
+        self.store.close()
+
+    def open(self, path=None, **kwargs) -> UserProgramStore:
+        return UserProgramStore(path or self.path, **kwargs)
+
+    def reopen(self) -> UserProgramStore:
+        self.store.close()
+        self.store = self.open()
+        return self.store
+
+
+class DeleteTest(StoreTestCase):
+    def test_delete_during_write_of_new_user(self):
+        self.store["1"] = dict(PROGRAM)
+        batch = self.store.collect()
+        del self.store["1"]
+        self.store.write(batch)
+        self.store.commit(batch)
+        self.assertNotIn("1", self.store)
+        self.store.save()
+        self.assertNotIn("1", self.reopen())
+
+    def test_delete_during_write_of_existing_user(self):
+        self.store["1"] = dict(PROGRAM)
+        self.store.save()
+        self.store["1"]["days"] = 4
+        self.store.mark_dirty("1")
+        batch = self.store.collect()
+        del self.store["1"]
+        self.store.write(batch)
+        self.store.commit(batch)
+        self.store.save()
+        self.assertNotIn("1", self.reopen())
+
+    def test_len_and_contains_after_delete(self):
+        self.store["1"] = dict(PROGRAM)
+        self.store["2"] = dict(PROGRAM)
+        self.store.save()
+        del self.store["1"]
+        self.assertNotIn("1", self.store)
+        self.assertIn("2", self.store)
+        self.assertEqual(len(self.store), 1)
+        self.store.save()
+        self.assertNotIn("1", self.store)
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(len(self.reopen()), 1)
+
+    def test_delete_unsaved_user(self):
+        self.store["1"] = dict(PROGRAM)
+        del self.store["1"]
+        self.assertNotIn("1", self.store)
+        self.assertEqual(len(self.store), 0)
+        with self.assertRaises(KeyError):
+            del self.store["1"]
+
+
+class SaveTest(StoreTestCase):
+    def test_in_place_edit_is_saved(self):
+        self.store["1"] = dict(PROGRAM)
+        self.store.save()
+        self.store["1"]["days"] = 5
+        self.assertEqual(self.store.save(), 1)
+        self.assertEqual(self.reopen()["1"]["days"], 5)
+
+    def test_in_place_edit_after_a_later_flush_is_saved(self):
+        self.store["1"] = dict(PROGRAM)
+        self.store.save()
+        record = self.store["1"]
+        # Another user's save runs between the read and the edit
+        self.store.write(self.store.collect())
+        record["days"] = 6
+        self.store.mark_dirty()
+        self.assertEqual(self.store.collect()[0], [])
+        # Compared once more when the touch expires
+        with mock.patch.object(storage, "TOUCH_GRACE_SECONDS", -1):
+            self.store._sweep(0)
+        self.assertEqual(self.store.save("1"), 1)
+        self.assertEqual(self.reopen()["1"]["days"], 6)
+
+    def test_unchanged_records_are_not_written(self):
+        self.store["1"] = dict(PROGRAM)
+        self.store.save()
+        self.store["1"]
+        self.assertEqual(self.store.save(), 0)
+
+    def test_reopen_keeps_records(self):
+        self.store["1"] = dict(PROGRAM)
+        self.store["2"] = {"days": 2, "note": "без программы"}
+        self.store.save()
+        store = self.reopen()
+        self.assertEqual(store["1"], PROGRAM)
+        self.assertEqual(store["2"], {"days": 2, "note": "без программы"})
+        self.assertEqual(sorted(store), ["1", "2"])
+
+
+class WriteBehindTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(prefix="bot-test-"), "users.db")
+        self.store = UserProgramStore(self.path)
+        self.write_behind = WriteBehind([self.store], interval=60, threshold=1000)
+
+    async def asyncTearDown(self):
+        await self.write_behind.stop()
+        self.store.close()
+
+    async def test_reopen_after_flush(self):
+        await self.write_behind.start()
+        self.store["1"] = dict(PROGRAM)
+        self.store.mark_dirty()
+        self.assertEqual(await self.write_behind.flush(), 1)
+        reopened = UserProgramStore(self.path)
+        try:
+            self.assertEqual(reopened["1"], PROGRAM)
+        finally:
+            reopened.close()
+
+    async def test_unencodable_record_is_dropped(self):
+        await self.write_behind.start()
+        self.store["bad"] = {"days": object()}
+        self.store["good"] = dict(PROGRAM)
+        self.store.mark_dirty()
+        with self.assertLogs("storage", "ERROR"):
+            self.assertEqual(await self.write_behind.flush(), 1)
+        self.assertTrue(self.write_behind.running)
+        reopened = UserProgramStore(self.path)
+        try:
+            self.assertIn("good", reopened)
+            self.assertNotIn("bad", reopened)
+        finally:
+            reopened.close()
+
+    async def test_flush_before_start(self):
+        self.store["1"] = dict(PROGRAM)
+        self.store.mark_dirty()
+        self.assertEqual(await self.write_behind.flush(), 1)
+        self.assertEqual(self.store.pending(), 0)
+
+    async def test_stop_saves_edits_made_before_the_last_flush(self):
+        await self.write_behind.start()
+        self.store["1"] = dict(PROGRAM)
+        self.store.mark_dirty()
+        await self.write_behind.flush()
+        record = self.store["1"]
+        await self.write_behind.flush()
+        record["days"] = 7
+        await self.write_behind.stop()
+        reopened = UserProgramStore(self.path)
+        try:
+            self.assertEqual(reopened["1"]["days"], 7)
+        finally:
+            reopened.close()
+
+
+class ShardSeedTest(StoreTestCase):
+    def test_each_user_lands_in_one_shard(self):
+        for i in range(50):
+            self.store[str(i)] = dict(PROGRAM)
+        self.store.save()
+        seen = []
+        for index in range(2):
+            with mock.patch.object(sharding, "SHARD_COUNT", 2), mock.patch.object(sharding, "SHARD_INDEX", index):
+                shard = self.open(sharding.shard_db_path(self.path, index), seed_db=self.path, shard_count=2)
+            try:
+                users = list(shard)
+                self.assertTrue(all(sharding.shard_for(u, 2) == index for u in users))
+                self.assertEqual(shard[users[0]], PROGRAM)
+                seen += users
+            finally:
+                shard.close()
+        self.assertEqual(sorted(seen, key=int), [str(i) for i in range(50)])
+
+    def test_changed_shard_count_is_refused(self):
+        self.open(sharding.shard_db_path(self.path, 0), shard_count=2).close()
+        with self.assertRaises(RuntimeError):
+            self.open(sharding.shard_db_path(self.path, 0), shard_count=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,25 +1,145 @@
+import asyncio
+import hashlib
 import logging
-from aiogram import Bot
+import os
+import time
+from collections import OrderedDict
 from aiogram.types import InlineKeyboardMarkup
 from aiogram.exceptions import TelegramBadRequest
-import settings.config as cfg
+from loader import bot
 
-bot = Bot(token=cfg.BOT_TOKEN)
+SUB_CACHE_POSITIVE_TTL = float(os.getenv("SUB_CACHE_POSITIVE_TTL", "300"))
+SUB_CACHE_NEGATIVE_TTL = float(os.getenv("SUB_CACHE_NEGATIVE_TTL", "30"))
+SUB_CACHE_SIZE = int(os.getenv("SUB_CACHE_SIZE", "10000"))
+# Query all channels at once and give up (as "not subscribed") after this many seconds
+SUB_CHECK_CONCURRENT = os.getenv("SUB_CHECK_CONCURRENT", "1") == "1"
+SUB_CHECK_TIMEOUT = float(os.getenv("SUB_CHECK_TIMEOUT", "5"))
+# Repeated "Проверить подписку" presses within this window are ignored
+SUB_CHECK_DEBOUNCE = float(os.getenv("SUB_CHECK_DEBOUNCE", "2"))
+RENDER_STATE_SIZE = int(os.getenv("RENDER_STATE_SIZE", "20000"))
 
-async def check_sub(channels: list[str], user_id: int) -> bool:
-    for channel in channels:
+
+class SubscriptionCache:
+    """LRU cache of (user_id, channel) -> subscribed with separate TTLs for
+    positive and negative results. Concurrent lookups of one key share a
+    single in-flight request."""
+
+    def __init__(self, positive_ttl: float, negative_ttl: float, maxsize: int):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[tuple, tuple[float, bool]] = OrderedDict()
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key: tuple) -> bool | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, subscribed = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return subscribed
+
+    def set(self, key: tuple, subscribed: bool):
+        ttl = self.positive_ttl if subscribed else self.negative_ttl
+        self._entries[key] = (time.monotonic() + ttl, subscribed)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    async def fetch(self, key: tuple, loader, force: bool = False) -> bool:
+        """Return the cached result for ``key`` or await ``loader()``.
+
+        ``loader`` returns ``(subscribed, cacheable)``; errors are not cached.
+        """
+        if not force:
+            cached = self.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        inflight = self._inflight.get(key)
+        while inflight is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+            # The owning lookup was cancelled by its caller; load it ourselves
+            inflight = self._inflight.get(key)
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
         try:
-            chat_member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
-            logging.info(f"User {user_id} status in channel {channel}: {chat_member.status}")
-            if chat_member.status in ["left", "kicked", "restricted"]:
+            subscribed, cacheable = await loader()
+            if cacheable:
+                self.set(key, subscribed)
+            future.set_result(subscribed)
+            return subscribed
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else is waiting
+            raise
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+sub_cache = SubscriptionCache(SUB_CACHE_POSITIVE_TTL, SUB_CACHE_NEGATIVE_TTL, SUB_CACHE_SIZE)
+
+
+async def _fetch_channel_status(channel: str, user_id: int) -> tuple[bool, bool]:
+    try:
+        chat_member = await bot.get_chat_member(chat_id=channel, user_id=user_id)
+        logging.debug("User %s status in channel %s: %s", user_id, channel, chat_member.status)
+        return chat_member.status not in ["left", "kicked", "restricted"], True
+    except TelegramBadRequest as e:
+        logging.error(f"Telegram API error checking subscription for user {user_id} in channel {channel}: {e}")
+        return False, False
+    except Exception as e:
+        logging.error(f"Unexpected error checking subscription for user {user_id} in channel {channel}: {e}")
+        return False, False
+
+
+def _check_channel(channel: str, user_id: int, force: bool):
+    return sub_cache.fetch((str(user_id), channel), lambda: _fetch_channel_status(channel, user_id), force=force)
+
+
+async def check_sub(channels: list[str], user_id: int, force: bool = False) -> bool:
+    """Проверяет подписку на все каналы; ``force`` обходит кэш."""
+    if not SUB_CHECK_CONCURRENT or len(channels) < 2:
+        for channel in channels:
+            if not await _check_channel(channel, user_id, force):
                 return False
-        except TelegramBadRequest as e:
-            logging.error(f"Telegram API error checking subscription for user {user_id} in channel {channel}: {e}")
-            return False
-        except Exception as e:
-            logging.error(f"Unexpected error checking subscription for user {user_id} in channel {channel}: {e}")
-            return False
-    return True
+        return True
+
+    tasks = [asyncio.create_task(_check_channel(channel, user_id, force)) for channel in channels]
+    try:
+        for next_done in asyncio.as_completed(tasks, timeout=SUB_CHECK_TIMEOUT):
+            if not await next_done:
+                return False
+        return True
+    except asyncio.TimeoutError:
+        logging.error(f"Subscription check for user {user_id} timed out after {SUB_CHECK_TIMEOUT}s")
+        return False
+    finally:
+        for task in tasks:
+            task.cancel()
 
 def are_markups_equal(markup1: InlineKeyboardMarkup | None, markup2: InlineKeyboardMarkup | None) -> bool:
     """Сравнивает две InlineKeyboardMarkup на равенство."""
@@ -37,4 +157,72 @@ def are_markups_equal(markup1: InlineKeyboardMarkup | None, markup2: InlineKeybo
         for btn1, btn2 in zip(row1, row2):
             if btn1.text != btn2.text or btn1.url != btn2.url or btn1.callback_data != btn2.callback_data:
                 return False
-    return True
\ No newline at end of file
+    return True
+
+def render_fingerprint(text: str, markup: InlineKeyboardMarkup | None) -> str:
+    """Хэш текста и клавиатуры сообщения."""
+    data = text + "\0" + (markup.model_dump_json(exclude_none=True) if markup else "")
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class RenderStateCache:
+    """LRU of (chat_id, message_id) -> fingerprint of what the bot last put in
+    the message, so edits that would change nothing are skipped without an API
+    call. Also debounces repeated button presses per user."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        # (chat_id, message_id) -> (fingerprint we set, fingerprint of the message as returned)
+        self._states: OrderedDict[tuple, tuple[str, str]] = OrderedDict()
+        self._presses: OrderedDict[str, float] = OrderedDict()
+        self.edits = 0
+        self.avoided = 0
+        self.debounced = 0
+
+    def _put(self, entries: OrderedDict, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+    def is_current(self, message, fingerprint: str) -> bool:
+        """Whether ``message`` already shows ``fingerprint``.
+
+        ``message`` carries its current content, so a cached entry only counts
+        while the message still looks exactly as it did after our last edit;
+        an edit made by any other handler invalidates it.
+        """
+        observed = render_fingerprint(message.html_text or "", message.reply_markup)
+        key = (message.chat.id, message.message_id)
+        if observed == fingerprint or self._states.get(key) == (fingerprint, observed):
+            self.avoided += 1
+            return True
+        return False
+
+    def remember(self, message, fingerprint: str, edited: bool = True):
+        """Record that ``message`` (as returned by Telegram) now shows ``fingerprint``."""
+        observed = render_fingerprint(message.html_text or "", message.reply_markup)
+        self._put(self._states, (message.chat.id, message.message_id), (fingerprint, observed))
+        if edited:
+            self.edits += 1
+
+    def debounce(self, user_id: str, interval: float = SUB_CHECK_DEBOUNCE) -> bool:
+        """True if ``user_id`` pressed within ``interval`` seconds of the last press."""
+        now = time.monotonic()
+        last = self._presses.get(user_id)
+        if last is not None and now - last < interval:
+            self.debounced += 1
+            return True
+        self._put(self._presses, user_id, now)
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._states),
+            "edits": self.edits,
+            "avoided": self.avoided,
+            "debounced": self.debounced,
+        }
+
+
+render_state = RenderStateCache(RENDER_STATE_SIZE)
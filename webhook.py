@@ -0,0 +1,178 @@
+# webhook.py
+import asyncio
+import logging
+import os
+import signal
+from typing import Optional, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONCURRENT = int(os.getenv("WEBHOOK_MAX_CONCURRENT", "100"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """aiohttp endpoint that feeds Telegram updates into the dispatcher.
+
+    Updates are acknowledged right away and handled in background tasks;
+    at most ``max_concurrent`` run at once, beyond that the request waits,
+    which makes Telegram slow down delivery instead of piling up tasks.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str = WEBHOOK_SECRET,
+                 max_concurrent: int = WEBHOOK_MAX_CONCURRENT, path: str = WEBHOOK_PATH):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.path = path
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._tasks: Set[asyncio.Task] = set()
+        self._runner: Optional[web.AppRunner] = None
+        self._closing = False
+        self.received = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self._closing:
+            return web.Response(status=503)
+        if self.secret and request.headers.get(SECRET_HEADER) != self.secret:
+            self.rejected += 1
+            logger.warning(f"Rejected webhook request from {request.remote}: bad secret token")
+            return web.Response(status=401)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"Malformed webhook update: {e}")
+            return web.Response(status=400)
+        self.received += 1
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: types.Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error handling update {update.update_id}: {e}")
+        finally:
+            self._semaphore.release()
+
+    async def start(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Webhook server listening on {host}:{port}{self.path}")
+
+    async def stop(self):
+        await self.drain()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        logger.info(f"Webhook server stopped: {self.stats()}")
+
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    async def drain(self, timeout: Optional[float] = WEBHOOK_DRAIN_TIMEOUT):
+        """Stop accepting updates and wait for the in-flight handlers."""
+        self._closing = True
+        if self._tasks:
+            logger.info(f"Draining {len(self._tasks)} in-flight updates")
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if pending:
+                logger.warning(f"{len(pending)} updates still running after {timeout}s, cancelling")
+                for task in pending:
+                    task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "in_flight": self.in_flight(),
+        }
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Serve updates over a webhook until SIGINT/SIGTERM, then drain in-flight handlers."""
+    server = WebhookServer(dp, bot)
+    await server.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+    try:
+        await bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_MAX_CONCURRENT, 100),
+        )
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+
+
+async def load_test(total: int, concurrency: int):
+    """Push synthetic updates through the real webhook path with a fake Bot API."""
+    import main
+    import loader
+    from fake_telegram import FakeTelegramSession, message_update, callback_update, post_updates
+
+    session = FakeTelegramSession()
+    loader.bot.session = session
+    main.setup_dispatcher()
+
+    server = WebhookServer(main.dp, main.bot)
+    await server.start("127.0.0.1", WEBHOOK_PORT)
+    makers = [
+        lambda uid: message_update(uid, "/start"),
+        lambda uid: message_update(uid, "/programma"),
+        lambda uid: callback_update(uid, "check_subscription"),
+    ]
+    updates = [makers[i % len(makers)](100000 + i % 1000) for i in range(total)]
+    started = asyncio.get_running_loop().time()
+    latencies = await post_updates(f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}", updates, WEBHOOK_SECRET, concurrency)
+    await server.stop()
+    await main.outbound.drain()
+    elapsed = asyncio.get_running_loop().time() - started
+    latencies.sort()
+    print(f"{total} updates in {elapsed:.2f}s ({total / elapsed:.0f} upd/s), "
+          f"ack p50={latencies[len(latencies) // 2] * 1000:.1f}ms p95={latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms, "
+          f"API calls: {dict(session.calls)}, server: {server.stats()}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load-test the webhook path offline")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(load_test(args.updates, args.concurrency))